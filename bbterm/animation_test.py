@@ -3,6 +3,7 @@ import time
 import io
 from PyQt5.QtWidgets import QApplication
 from .main import MainWindow
+from .session import Session
 
 
 class AnimationTest(io.IOBase):
@@ -25,9 +26,14 @@ class AnimationTest(io.IOBase):
         now = time.time()
         if (now - self._start_time) > 0.01 and self._x < 255:
             self._start_time = now
-            frame = bytearray(b'\x1b/B\x00\x00\x1b/H\x04\x00')
+            # Restore only the area under the sprite's previous position
+            frame = bytearray(b'\x1b/F\x01\x00\x01')
+            frame.extend(b'\x1b/R\x09\x00\x00')
+            frame.extend(bytes([self._x - 1, 0, 0, 1, 32, 0, 32, 0]))
+            frame.extend(b'\x1b/H\x04\x00')
             frame.extend(bytes([self._x, 0, 0, 1]))
             frame.extend(bytes('\x1b/D\x02\x00\x00\x00', 'ascii'))
+            frame.extend(b'\x1b/F\x01\x00\x00')
             self._data.extend(frame)
             self._x += 1
             if self._x >= 255:
@@ -39,7 +45,7 @@ class AnimationTest(io.IOBase):
 def unit_test():
     app = QApplication(sys.argv)
     stream = AnimationTest()
-    window = MainWindow(stream)
+    window = MainWindow([Session(stream)])
     window.show()
     app.exec_()
 
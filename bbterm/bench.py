@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Headless benchmark of the parse/render pipeline.
+
+Each workload is a deterministic byte stream that is fed through
+ClientProtocol.process from an in-memory stream, as fast as the parser accepts it.
+Results are printed (or written) as JSON so runs can be compared between releases.
+"""
+import io
+import json
+import platform
+import random
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+import argh
+from .canvas import Canvas
+from .font import SIZE
+from .protocol import ClientProtocol
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+COLUMNS = 40
+ROWS = 25
+
+# A workload returns its input stream, the number of escape commands in it and the number of frames
+Workload = Tuple[bytes, int, int]
+
+
+class BenchStream(io.BytesIO):
+    """ In-memory input stream. Replies from the terminal are collected separately """
+
+    def __init__(self, data: bytes):
+        super().__init__(data)
+        self.replies = bytearray()
+
+    def write(self, data: bytes):
+        self.replies.extend(data)
+        return len(data)
+
+
+def _text(rng: random.Random, length: int) -> bytes:
+    words = [b'the', b'quick', b'brown', b'fox', b'jumps', b'over', b'lazy', b'dog', b'BBS', b'files',
+             b'message', b'board', b'sysop', b'download', b'[Y/n]', b'...', b'1200', b'baud']
+    out = bytearray()
+    while len(out) < length:
+        out += rng.choice(words) + b' '
+    return bytes(out[:length])
+
+
+def text_flood(rng: random.Random) -> Workload:
+    """ Plain text that wraps and scrolls, like a file listing """
+    data = b'\x1b[0m\x1b[1;1H' + _text(rng, 64 * 1024)
+    return data, 0, 0
+
+
+def sgr_art(rng: random.Random) -> Workload:
+    """ ANSI art with a color change on almost every cell """
+    out = bytearray()
+    commands = 0
+    for screen in range(10):
+        out += b'\x1b[1;1H'
+        commands += 1
+        for cell in range(COLUMNS * ROWS - 1):
+            out += b'\x1b[%d;%d;%dm' % (rng.choice((0, 1)), 30 + rng.randrange(8), 40 + rng.randrange(8))
+            out.append(rng.choice(b'\xb0\xb1\xb2\xdb\xdc\xdf '))
+            commands += 1
+    return bytes(out), commands, 0
+
+
+def screen_redraw(rng: random.Random) -> Workload:
+    """ The same colored menu screen repainted from the top, like a BBS refreshing its main menu """
+    screen = bytearray(b'\x1b[1;1H')
+    for row in range(ROWS - 1):
+        screen += b'\x1b[%d;%dm' % (30 + row % 8, 40 + (row // 8) % 8) + _text(rng, COLUMNS - 1) + b'\r'
+    return bytes(screen) * 50, 50 * ROWS, 50
+
+
+def cursor_redraw(rng: random.Random) -> Workload:
+    """ Short updates at random cursor positions, like a full screen editor or status panels """
+    out = bytearray()
+    for _ in range(20000):
+        row = rng.randrange(1, ROWS)
+        col = rng.randrange(1, COLUMNS - 8)
+        out += b'\x1b[%d;%dH' % (row, col) + _text(rng, 8)
+    return bytes(out), 20000, 0
+
+
+def scroll_storm(rng: random.Random) -> Workload:
+    """ Full lines written on the bottom row, so every line scrolls the screen """
+    out = bytearray(b'\x1b[0m\x1b[%d;1H' % ROWS)
+    for _ in range(1000):
+        out += _text(rng, COLUMNS)
+    return bytes(out), 0, 0
+
+
+def chat_pane(rng: random.Random) -> Workload:
+    """ Chat lines scrolling inside a scroll region, with a status bar updated in place below it """
+    out = bytearray(b'\x1b[0m\x1b[2J\x1b[1;%dr' % (ROWS - 2))
+    commands = 2
+    for k in range(1000):
+        out += b'\x1b[%d;1H' % (ROWS - 2) + b'\r' + _text(rng, COLUMNS // 2)
+        out += b'\x1b[s\x1b[%d;1H\x1b[44m\x1b[2K%d users online\x1b[0m\x1b[u' % (ROWS, 10 + k % 7)
+        commands += 6
+    return bytes(out), commands, 0
+
+
+def _slash(code: bytes, payload: bytes) -> bytes:
+    return b'\x1b/' + code + len(payload).to_bytes(2, 'little') + payload
+
+
+def _sprite_animation(rng: random.Random, bulk: bool) -> Workload:
+    out = bytearray(b'\x1b[0m\x1b[2J')
+    sprites = 16
+    objects = 8
+    frames = 500
+    images = []
+    for index in range(sprites):
+        pixels = bytes(rng.getrandbits(8) for _ in range(SIZE * SIZE * 3))
+        rgba = bytearray(SIZE * SIZE * 4)
+        rgba[0::4] = pixels[0::3]
+        rgba[1::4] = pixels[1::3]
+        rgba[2::4] = pixels[2::3]
+        rgba[3::4] = bytes(255 if (i % SIZE) < 24 else 0 for i in range(SIZE * SIZE))
+        images.append(bytes(rgba))
+    if bulk:
+        # 15 RGBA sprites fit in one payload
+        for first in range(0, sprites, 15):
+            batch = images[first:first + 15]
+            out += _slash(b'U', first.to_bytes(2, 'little') + len(batch).to_bytes(2, 'little') + b''.join(batch))
+        commands = (sprites + 14) // 15
+    else:
+        for index, rgba in enumerate(images):
+            out += _slash(b'S', index.to_bytes(2, 'little') + rgba)
+        commands = sprites
+    out += _slash(b'A', b'')
+    commands += 1
+    positions = [(rng.randrange(0, COLUMNS * SIZE - SIZE), rng.randrange(0, ROWS * SIZE - SIZE))
+                 for _ in range(objects)]
+    previous = []
+    for frame in range(frames):
+        if bulk:
+            out += _slash(b'F', b'\1')
+            commands += 1
+            # Restore only the areas under the previous frame's sprites
+            for x, y in previous:
+                out += _slash(b'R', b'\0' + b''.join(v.to_bytes(2, 'little') for v in (x, y, SIZE, SIZE)))
+            commands += len(previous)
+            previous = []
+        else:
+            out += _slash(b'B', b'')
+            commands += 1
+        draws = bytearray()
+        for k, (x, y) in enumerate(positions):
+            x = (x + frame * 3) % (COLUMNS * SIZE - SIZE)
+            if bulk:
+                draws += (k % sprites).to_bytes(2, 'little') + x.to_bytes(2, 'little') + y.to_bytes(2, 'little')
+                previous.append((x, y))
+            else:
+                out += _slash(b'H', x.to_bytes(2, 'little') + y.to_bytes(2, 'little'))
+                out += _slash(b'D', (k % sprites).to_bytes(2, 'little'))
+                commands += 2
+        if bulk:
+            out += _slash(b'M', bytes(draws))
+            out += _slash(b'F', b'\0')
+            commands += 2
+    return bytes(out), commands, frames
+
+
+def sprite_animation(rng: random.Random) -> Workload:
+    """ Slash protocol animation: restore the background and redraw moving sprites every frame """
+    return _sprite_animation(rng, False)
+
+
+def sprite_animation_bulk(rng: random.Random) -> Workload:
+    """ The sprite animation using bulk upload, multi sprite draw, rectangle restore and frame commands """
+    return _sprite_animation(rng, True)
+
+
+workloads: Dict[str, Callable[[random.Random], Workload]] = {
+    'text': text_flood,
+    'sgr': sgr_art,
+    'redraw': screen_redraw,
+    'cursor': cursor_redraw,
+    'scroll': scroll_storm,
+    'chat': chat_pane,
+    'sprites': sprite_animation,
+    'sprites-bulk': sprite_animation_bulk,
+}
+
+
+def peak_rss_kb() -> Optional[int]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def run_workload(data: bytes) -> Tuple[float, Dict[str, int]]:
+    """ Seconds to process the data, and the display list statistics """
+    stream = BenchStream(data)
+    protocol = ClientProtocol(stream, Canvas(SIZE * COLUMNS, SIZE * ROWS))
+    n = len(data)
+    start = time.perf_counter()
+    while True:
+        protocol.process()
+        if stream.tell() >= n and not protocol.has_backlog():
+            break
+    return time.perf_counter() - start, protocol.get_display_list().stats()
+
+
+def run_benchmarks(workload: List[str] = None, repeat: int = 3, seed: int = 1, output: str = None):
+    """ Run the benchmark workloads and report the best of <repeat> runs as JSON """
+    names = workload if workload else list(workloads.keys())
+    results = {}
+    for name in names:
+        if name not in workloads:
+            raise argh.CommandError(f'Unknown workload {name}, choose from {", ".join(workloads)}')
+        data, commands, frames = workloads[name](random.Random(seed))
+        runs = [run_workload(data) for _ in range(max(1, repeat))]
+        seconds = min(seconds for seconds, _ in runs)
+        display = runs[0][1]
+        results[name] = {
+            'bytes': len(data),
+            'seconds': round(seconds, 6),
+            'mb_per_s': round(len(data) / seconds / 1e6, 4),
+            'commands_per_s': round(commands / seconds, 1) if commands else None,
+            'frames_per_s': round(frames / seconds, 1) if frames else None,
+            'display_ops': display['recorded'],
+            'display_ops_dropped': display['dropped'],
+        }
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': repeat,
+        'seed': seed,
+        'workloads': results,
+        # The process wide peak, ru_maxrss never goes down so it can't be told apart per workload
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    text = json.dumps(report, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def main():
+    argh.dispatch_command(run_benchmarks)
+
+
+if __name__ == '__main__':
+    main()
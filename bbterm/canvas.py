@@ -1,40 +1,92 @@
-from typing import Optional, Dict
-from PyQt5.QtCore import QRect
-from PyQt5.QtGui import QPixmap, QPainter, QImage, QColor
+import time
+from typing import Optional, Dict, Tuple, List
+import numpy as np
 from .font import Font, create_font
 from .inline_font import SIZE
+from .sprites import Sprite
+from .scrollback import Scrollback, CELL_DTYPE, CELL_DRAWN, BLANK, DEFAULT_SCROLLBACK_LINES
+
+Color = Tuple[int, int, int]
+Rect = Tuple[int, int, int, int]
+
+MAX_BACKGROUND_SLOTS = 8
+
+# Beyond this many damaged rectangles, merge them into their bounding box
+MAX_DAMAGE_RECTS = 64
+
+# An open frame holds back repaints for at most this long (seconds)
+FRAME_TIMEOUT = 0.1
+
+
+def _rgb(color: int) -> Color:
+    return (color >> 16) & 255, (color >> 8) & 255, color & 255
 
 
 class Canvas:
-    def __init__(self, w: int, h: int):
-        self._pixmap = QPixmap(w, h)
-        self._pixmap.fill(QColor(0, 0x80, 0))
-        self._painter = QPainter(self._pixmap)
-        self._saved_blink_cursor = (0, 0)
-        self._saved_blink: Optional[QPixmap] = None
+    """
+    Software framebuffer that the protocol draws into.
+
+    Pixels live in an HxWx4 uint8 RGBA numpy array, so every drawing primitive
+    is a slice operation and the whole parse/render path runs without Qt.
+    A GUI front end wraps get_pixels() in an image object only when it paints.
+    """
+
+    def __init__(self, w: int, h: int, scrollback_lines: int = DEFAULT_SCROLLBACK_LINES):
+        self._pixels = np.empty((h, w, 4), dtype=np.uint8)
+        self._pixels[...] = (0, 0x80, 0, 255)
+        # The characters on screen, kept next to the pixels so text can move to the scrollback
+        self._cells = np.empty((h // SIZE, w // SIZE), dtype=CELL_DTYPE)
+        self._cells[...] = (BLANK, 0xFFFFFF, 0x008000, 0)
+        self._scrollback = Scrollback(w // SIZE, scrollback_lines)
+        self._cursor_shown = False
         self._cursor = (0, 0)
+        self._cursor_stack: List[Tuple[int, int]] = []
         self._fonts: Dict[int, Font] = {0: create_font(self)}
         self._cur_font = 0
-        self._blink_count = 0
         self._blink = True
+        self._damage: List[Rect] = [self.rect()]
+        # Saved pixels and the cells that describe them, per slot
+        self._backgrounds: Dict[int, Tuple[np.ndarray, np.ndarray]] = {}
+        self._frame_deadline: Optional[float] = None
+        self._scroll_region = (0, len(self._cells))
+        self._sprites: Dict[int, Sprite] = {}
 
     def get_font(self) -> Font:
         return self._fonts[self._cur_font]
 
     def set_blink(self, state: bool):
         self._blink = state
+        if not state and self._cursor_shown:
+            self.blink()
+
+    def get_blink(self) -> bool:
+        return self._blink
 
-    def process_blink_counter(self):
+    def process_blink(self):
+        """ Toggle the cursor, called once per blink interval """
         if self._blink:
-            self._blink_count += 1
-            if self._blink_count >= 50:
-                self._blink_count = 0
-                self.blink(self._cursor[0], self._cursor[1])
-                return True
+            self.blink()
+            return True
         return False
 
+    def blink(self):
+        self._cursor_shown = not self._cursor_shown
+        self._add_damage(self._cursor[0], self._cursor[1], SIZE, SIZE)
+
+    def get_cursor_overlay(self) -> Optional[Rect]:
+        """
+        The cell that should be drawn inverted for the cursor, or None while it is hidden.
+        The cursor is never drawn into the pixels, front ends compose it when painting.
+        """
+        if self._cursor_shown:
+            return self._cursor[0], self._cursor[1], SIZE, SIZE
+        return None
+
     def set_cursor(self, cursor):
         if self.valid_cursor(cursor):
+            if self._cursor_shown and cursor != self._cursor:
+                self._add_damage(self._cursor[0], self._cursor[1], SIZE, SIZE)
+                self._add_damage(cursor[0], cursor[1], SIZE, SIZE)
             self._cursor = cursor
 
     def valid_cursor(self, cursor):
@@ -44,55 +96,313 @@ class Canvas:
     def get_cursor(self):
         return self._cursor
 
-    def get_pixmap(self):
-        return self._pixmap
+    def push_cursor(self):
+        self._cursor_stack.append(self._cursor)
+
+    def pop_cursor(self):
+        if self._cursor_stack:
+            self.set_cursor(self._cursor_stack.pop())
+
+    def set_sprite(self, index: int, data):
+        self._sprites[index] = Sprite(data)
+
+    def get_sprite(self, index: int) -> Optional[Sprite]:
+        return self._sprites.get(index)
+
+    def get_pixels(self) -> np.ndarray:
+        return self._pixels
 
     def width(self):
-        return self._pixmap.width()
+        return self._pixels.shape[1]
 
     def height(self):
-        return self._pixmap.height()
-
-    def rect(self):
-        return self._pixmap.rect()
-
-    def fill(self, color: QColor):
-        self._clear_blink()
-        self._pixmap.fill(color)
-
-    def draw_image(self, x: int, y: int, image: QImage):
-        self._clear_blink()
-        self._painter.drawImage(x, y, image)
-
-    def draw_sub_image(self, target: QRect, image: QImage, source: QRect):
-        self._clear_blink()
-        self._painter.drawImage(target, image, source)
-
-    def copy_from(self, other: QPixmap):
-        self._clear_blink()
-        self._painter.drawPixmap(0, 0, other)
-
-    def scroll(self, x, y):
-        self._clear_blink()
-        self._pixmap.scroll(x, y, self._pixmap.rect())
-
-    def _clear_blink(self):
-        if self._saved_blink is not None:
-            rect = QRect(self._saved_blink_cursor[0], self._saved_blink_cursor[1], SIZE, SIZE)
-            self._painter.drawPixmap(rect, self._saved_blink)
-            self._saved_blink = None
-
-    def blink(self, x, y):
-        if self._saved_blink is not None:
-            rect = QRect(self._saved_blink_cursor[0], self._saved_blink_cursor[1], SIZE, SIZE)
-            self._painter.drawPixmap(rect, self._saved_blink)
-            self._saved_blink = None
+        return self._pixels.shape[0]
+
+    def rect(self) -> Rect:
+        return 0, 0, self.width(), self.height()
+
+    def get_cells(self) -> np.ndarray:
+        return self._cells
+
+    def get_scrollback(self) -> Scrollback:
+        return self._scrollback
+
+    def changed_cells(self, x: int, y: int, codes, fg: int, bg: int) -> Tuple[int, int]:
+        """
+        The part of a text run at (x,y) that isn't already on screen, as (start, end) indices into codes.
+        start == end if drawing the run would not change any pixel.
+        """
+        n = len(codes)
+        if x % SIZE or y % SIZE:
+            return 0, n
+        row, col = y // SIZE, x // SIZE
+        if n == 1:
+            return (1, 1) if self._cells[row, col].item() == (codes[0], fg, bg, CELL_DRAWN) else (0, 1)
+        # Runs are at most a line long, where plain comparisons beat a handful of numpy calls
+        cells = self._cells[row, col:col + n].tolist()
+        start = 0
+        while start < n and cells[start] == (codes[start], fg, bg, CELL_DRAWN):
+            start += 1
+        if start == n:
+            return n, n
+        end = n
+        while cells[end - 1] == (codes[end - 1], fg, bg, CELL_DRAWN):
+            end -= 1
+        return start, end
+
+    def set_cells(self, x: int, y: int, codes, fg: int, bg: int):
+        """ Record the characters of a text run drawn at (x,y) """
+        if x % SIZE or y % SIZE:
+            # Off the character grid, only the pixels know about it
+            return
+        row, col = y // SIZE, x // SIZE
+        if len(codes) == 1:
+            self._cells[row, col] = (codes[0], fg, bg, CELL_DRAWN)
+            return
+        cells = self._cells[row, col:col + len(codes)]
+        cells['ch'] = np.frombuffer(codes, dtype=np.uint8, count=len(cells))
+        cells['fg'] = fg
+        cells['bg'] = bg
+        cells['flags'] = CELL_DRAWN
+
+    def get_scroll_region(self) -> Tuple[int, int]:
+        """ The rows that scroll, as (top, bottom) with bottom exclusive """
+        return self._scroll_region
+
+    def set_scroll_region(self, top: int, bottom: int):
+        rows = len(self._cells)
+        top, bottom = max(top, 0), min(bottom, rows)
+        self._scroll_region = (top, bottom) if top < bottom - 1 else (0, rows)
+
+    def scroll_lines(self, count: int, fg: int, bg: int,
+                     top: Optional[int] = None, bottom: Optional[int] = None, history: bool = False):
+        """
+        Scroll rows top..bottom-1 (the scroll region by default) up by count lines, or down if count is negative.
+        With history, lines that leave the top of the screen go to the scrollback. Exposed lines are erased.
+        """
+        top, bottom = self._region(top, bottom)
+        count = self.shift_cells(count, fg, bg, top, bottom, history)
+        if count != 0:
+            self._shift_pixels(0, -count * SIZE, (0, top * SIZE, self.width(), (bottom - top) * SIZE))
+            exposed = bottom - count if count > 0 else top
+            self._fill_pixels((0, exposed * SIZE, self.width(), abs(count) * SIZE), _rgb(bg))
+
+    def shift_cells(self, count: int, fg: int, bg: int,
+                    top: Optional[int] = None, bottom: Optional[int] = None, history: bool = False) -> int:
+        """
+        The text half of scroll_lines: moves the characters and blanks the exposed rows, the pixels are left alone.
+        Returns the number of lines scrolled, after clamping to the region.
+        """
+        top, bottom = self._region(top, bottom)
+        rows = bottom - top
+        count = max(-rows, min(count, rows))
+        if count == 0 or rows <= 0:
+            return 0
+        cols = self._cells.shape[1]
+        if count > 0:
+            if history and top == 0:
+                self._scrollback.push(self._cells[:count])
+            self._cells[top:bottom - count] = self._cells[top + count:bottom]
+            exposed = bottom - count
         else:
-            self._saved_blink = self._pixmap.copy(QRect(x, y, SIZE, SIZE))
-            self._saved_blink_cursor = x, y
-            image = self._saved_blink.toImage()
-            for i in range(SIZE):
-                for j in range(SIZE):
-                    p = 0xFF000000 | (~image.pixel(i, j) & 0xFFFFFF)
-                    image.setPixel(i, j, p)
-            self._painter.drawImage(x, y, image)
+            self._cells[top - count:bottom] = self._cells[top:bottom + count]
+            exposed = top
+        self.clear_cells((0, exposed, cols, abs(count)), fg, bg)
+        return count
+
+    def _region(self, top: Optional[int], bottom: Optional[int]) -> Tuple[int, int]:
+        region_top, region_bottom = self._scroll_region
+        return region_top if top is None else top, region_bottom if bottom is None else bottom
+
+    def erase_cells(self, rect: Rect, fg: int, bg: int):
+        """ Clear a rectangle of cells, given in columns and rows, to blanks in the background color """
+        col, row, cols, rows = rect
+        self._fill_pixels((col * SIZE, row * SIZE, cols * SIZE, rows * SIZE), _rgb(bg))
+        self.clear_cells(rect, fg, bg)
+
+    def clear_cells(self, rect: Rect, fg: int, bg: int):
+        """ The text half of erase_cells: blanks the characters, the pixels are left alone """
+        col, row, cols, rows = rect
+        flags = CELL_DRAWN if self.get_font().is_blank(BLANK) else 0
+        self._cells[max(row, 0):row + rows, max(col, 0):col + cols] = (BLANK, fg, bg, flags)
+
+    def redraw_cells(self, before: np.ndarray, shift: int = 0,
+                     top: Optional[int] = None, bottom: Optional[int] = None):
+        """
+        Bring the pixels up to date after only the text was changed (set_cells, clear_cells, shift_cells).
+        before is a copy of the cells the pixels show, and shift the lines rows top..bottom-1 were scrolled by since.
+        The pixels are scrolled once, then only the characters that differ are drawn.
+        """
+        top, bottom = self._region(top, bottom)
+        rows = bottom - top
+        shown = before.copy()
+        if shift != 0 and rows > 0:
+            shift = max(-rows, min(shift, rows))
+            if abs(shift) < rows:
+                self._shift_pixels(0, -shift * SIZE, (0, top * SIZE, self.width(), rows * SIZE))
+            if shift > 0:
+                shown[top:bottom - shift] = before[top + shift:bottom]
+                shown['flags'][bottom - shift:bottom] = 0
+            else:
+                shown[top - shift:bottom] = before[top:bottom + shift]
+                shown['flags'][top:top - shift] = 0
+        # Cells that aren't drawn text were carried along with their pixels
+        stale = (self._cells != shown) & (self._cells['flags'] & CELL_DRAWN != 0)
+        font = self.get_font()
+        for row in np.flatnonzero(stale.any(axis=1)).tolist():
+            columns = np.flatnonzero(stale[row])
+            # Split into runs of consecutive columns
+            breaks = np.flatnonzero(np.diff(columns) != 1) + 1
+            for run in np.split(columns, breaks):
+                start, end = int(run[0]), int(run[-1]) + 1
+                x, y = start * SIZE, row * SIZE
+                self._pixels[y:y + SIZE, x:end * SIZE] = font.render_cells(self._cells[row, start:end])
+                self._add_damage(x, y, (end - start) * SIZE, SIZE)
+
+    def take_damage(self) -> List[Rect]:
+        """ Return the rectangles changed since the last call, and reset the list """
+        damage = self._damage
+        self._damage = []
+        return damage
+
+    def begin_frame(self):
+        """ Start a frame, the damage is not painted until end_frame() or the frame timeout """
+        # A frame that is already open keeps its deadline, so a server can't postpone painting forever
+        if self._frame_deadline is None:
+            self._frame_deadline = time.monotonic() + FRAME_TIMEOUT
+
+    def end_frame(self):
+        self._frame_deadline = None
+
+    def frame_remaining(self) -> float:
+        """ Seconds until the open frame times out, or 0 if the damage can be painted now """
+        if self._frame_deadline is None:
+            return 0
+        remaining = self._frame_deadline - time.monotonic()
+        if remaining <= 0:
+            self._frame_deadline = None
+            return 0
+        return remaining
+
+    def _add_damage(self, x: int, y: int, w: int, h: int):
+        damage = self._damage
+        if len(damage) == 1 and damage[0] == self.rect():
+            return
+        damage.append((x, y, w, h))
+        if len(damage) > MAX_DAMAGE_RECTS:
+            x0 = min(r[0] for r in damage)
+            y0 = min(r[1] for r in damage)
+            x1 = max(r[0] + r[2] for r in damage)
+            y1 = max(r[1] + r[3] for r in damage)
+            self._damage = [(x0, y0, x1 - x0, y1 - y0)]
+
+    def _damage_all(self):
+        self._damage = [self.rect()]
+
+    def _fill_pixels(self, rect: Rect, color: Color):
+        target, _ = self._clip_rect(*rect)
+        if target is not None:
+            self._pixels[target][..., :3] = color
+            self._add_target_damage(target)
+        return target
+
+    def draw_image(self, x: int, y: int, image: np.ndarray):
+        """ Alpha blend an RGBA image onto the canvas """
+        target, source = self._clip(x, y, image)
+        if target is not None:
+            src = image[source]
+            alpha = src[..., 3:4].astype(np.uint32)
+            dst = self._pixels[target][..., :3]
+            dst[...] = (src[..., :3] * alpha + dst * (255 - alpha) + 127) // 255
+            self._add_target_damage(target)
+            self._undraw_cells(target)
+
+    def draw_masked(self, x: int, y: int, image: np.ndarray, mask: np.ndarray):
+        """ Copy the pixels of an image where its HxWx1 boolean mask is set """
+        target, source = self._clip(x, y, image)
+        if target is not None:
+            np.copyto(self._pixels[target], image[source], where=mask[source])
+            self._add_target_damage(target)
+            self._undraw_cells(target)
+
+    def draw_sub_image(self, x: int, y: int, image: np.ndarray):
+        """ Copy an opaque RGBA tile onto the canvas """
+        target, source = self._clip(x, y, image)
+        if target is not None:
+            self._pixels[target] = image[source]
+            self._add_target_damage(target)
+            self._undraw_cells(target)
+
+    def store_background(self, slot: int = 0):
+        """ Save a copy of the whole canvas in a numbered slot """
+        if 0 <= slot < MAX_BACKGROUND_SLOTS:
+            saved = self._backgrounds.get(slot)
+            if saved is None:
+                self._backgrounds[slot] = (self._pixels.copy(), self._cells.copy())
+            else:
+                saved[0][...] = self._pixels
+                saved[1][...] = self._cells
+
+    def has_background(self, slot: int) -> bool:
+        return slot in self._backgrounds
+
+    def restore_background(self, slot: int = 0, rect: Optional[Rect] = None):
+        """ Copy a saved slot back, either the whole canvas or only the given rectangle """
+        saved = self._backgrounds.get(slot)
+        if saved is None:
+            return
+        pixels, cells = saved
+        if rect is None:
+            self._pixels[...] = pixels
+            self._cells[...] = cells
+            self._damage_all()
+        else:
+            target, _ = self._clip_rect(*rect)
+            if target is not None:
+                self._pixels[target] = pixels[target]
+                self._add_target_damage(target)
+                self._undraw_cells(target)
+
+    def _shift_pixels(self, x: int, y: int, rect: Optional[Rect] = None):
+        target, _ = self._clip_rect(*(rect or self.rect()))
+        if target is None:
+            return None
+        rows, cols = target
+        w, h = cols.stop - cols.start, rows.stop - rows.start
+        if abs(x) >= w or abs(y) >= h:
+            return None
+        dst_x, src_x = cols.start + max(x, 0), cols.start + max(-x, 0)
+        dst_y, src_y = rows.start + max(y, 0), rows.start + max(-y, 0)
+        cw, ch = w - abs(x), h - abs(y)
+        if x == 0 and w == self.width():
+            # Whole rows are one contiguous block, a flat copy avoids numpy's overlap buffering
+            flat = self._pixels.reshape(-1)
+            row = w * 4
+            flat[dst_y * row:(dst_y + ch) * row] = flat[src_y * row:(src_y + ch) * row]
+        else:
+            self._pixels[dst_y:dst_y + ch, dst_x:dst_x + cw] = self._pixels[src_y:src_y + ch, src_x:src_x + cw]
+        self._add_damage(dst_x, dst_y, cw, ch)
+        return target
+
+    def _clip(self, x: int, y: int, image: np.ndarray):
+        return self._clip_rect(x, y, image.shape[1], image.shape[0])
+
+    def _clip_rect(self, x: int, y: int, w: int, h: int):
+        """ Returns the canvas slices of a rectangle clipped to the canvas, and the matching slices inside it """
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width()), min(y + h, self.height())
+        if x0 >= x1 or y0 >= y1:
+            return None, None
+        target = (slice(y0, y1), slice(x0, x1))
+        source = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+        return target, source
+
+    def _undraw_cells(self, target):
+        # Something other than text was drawn over these cells
+        rows, cols = target
+        self._cells['flags'][rows.start // SIZE:(rows.stop + SIZE - 1) // SIZE,
+                             cols.start // SIZE:(cols.stop + SIZE - 1) // SIZE] = 0
+
+    def _add_target_damage(self, target):
+        rows, cols = target
+        self._add_damage(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
@@ -0,0 +1,94 @@
+import zlib
+from typing import Optional
+from .errors import ProtocolError
+
+# Compression methods of the slash protocol 'Z' command
+METHOD_ZLIB = 1
+METHOD_RLE = 2
+
+# Limit for a single decompressed payload, to protect against decompression bombs
+MAX_DECOMPRESSED = 16 * 1024 * 1024
+
+_BLACK = bytes(3 * 128)
+
+
+def inflate(data) -> bytes:
+    decompressor = zlib.decompressobj()
+    try:
+        out = decompressor.decompress(data, MAX_DECOMPRESSED)
+    except zlib.error as e:
+        raise ProtocolError(f"Invalid compressed payload: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError("Compressed payload too large")
+    return out
+
+
+def rle_decode(data, header: int) -> bytes:
+    """
+    Decode a color keyed RLE payload. The first <header> bytes are copied as is,
+    followed by runs of RGB pixels. Each run starts with a control byte c:
+    10xxxxxx..11xxxxxx: (c & 0x7F) + 1 transparent (black) pixels
+    01xxxxxx: (c & 0x3F) + 1 copies of the RGB pixel that follows
+    00xxxxxx: (c & 0x3F) + 1 literal RGB pixels follow
+    """
+    n = len(data)
+    if n < header:
+        raise ProtocolError("Truncated RLE payload")
+    chunks = [bytes(data[:header])]
+    size = 0
+    i = header
+    while i < n:
+        c = data[i]
+        i += 1
+        if c & 0x80:
+            chunk = _BLACK[:3 * ((c & 0x7F) + 1)]
+        elif c & 0x40:
+            chunk = bytes(data[i:i + 3]) * ((c & 0x3F) + 1)
+            i += 3
+        else:
+            chunk = bytes(data[i:i + 3 * (c + 1)])
+            i += 3 * (c + 1)
+        if i > n:
+            raise ProtocolError("Truncated RLE payload")
+        size += len(chunk)
+        if size > MAX_DECOMPRESSED:
+            raise ProtocolError("Compressed payload too large")
+        chunks.append(chunk)
+    return b''.join(chunks)
+
+
+def rle_encode(rgb: bytes) -> bytes:
+    """ Encode RGB pixels (black is transparent) in the format rle_decode reads. For servers and tests """
+    pixels = [rgb[k:k + 3] for k in range(0, len(rgb) - 2, 3)]
+    out = bytearray()
+    n = len(pixels)
+    i = 0
+    while i < n:
+        j = i + 1
+        if pixels[i] == b'\0\0\0':
+            while j < n and j - i < 128 and pixels[j] == pixels[i]:
+                j += 1
+            out.append(0x80 | (j - i - 1))
+        else:
+            while j < n and j - i < 64 and pixels[j] == pixels[i]:
+                j += 1
+            if j - i > 1:
+                out.append(0x40 | (j - i - 1))
+                out += pixels[i]
+            else:
+                # Literal run up to the next transparent pixel or repeated color
+                while j < n and j - i < 64 and pixels[j] != b'\0\0\0' and \
+                        (j + 1 >= n or pixels[j + 1] != pixels[j]):
+                    j += 1
+                out.append(j - i - 1)
+                out += b''.join(pixels[i:j])
+        i = j
+    return bytes(out)
+
+
+def decompress(method: int, data, header: int) -> Optional[bytes]:
+    if method == METHOD_ZLIB:
+        return inflate(data)
+    if method == METHOD_RLE:
+        return rle_decode(data, header)
+    return None
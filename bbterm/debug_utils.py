@@ -9,7 +9,8 @@ def diagnostic_dump(data):
 			with open('dump.bin', 'ab') as f:
 				f.write(data)
 
-def diag(message):
+def diag(message, *args):
+	# Formatting waits until diagnostics are on, so calls on hot paths cost next to nothing
 	if diagnostics:
-		print(message)
+		print(message % args if args else message)
 
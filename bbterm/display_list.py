@@ -0,0 +1,289 @@
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+import numpy as np
+from .canvas import Canvas, MAX_BACKGROUND_SLOTS, Rect
+from .inline_font import SIZE
+from .scrollback import BLANK
+
+OP_GLYPHS, OP_ERASE, OP_SCROLL, OP_BLIT, OP_STORE, OP_RESTORE = range(6)
+OP_NAMES = ('glyphs', 'erase', 'scroll', 'blit', 'store', 'restore')
+
+# Every operation is FIELDS ints: its kind, the pixel rectangle it writes, then its own arguments
+OP, X, Y, W, H, A, B, C, D, FG, BG = range(11)
+FIELDS = 11
+
+BLIT_OPAQUE, BLIT_MASKED, BLIT_BLEND = range(3)
+
+# The optimizer compares each image with at most this many of the ones that overwrite pixels after it
+MAX_COVERS = 16
+
+
+class DisplayList:
+    """
+    The drawing that one processing step asked for, as an array of fixed size operations:
+    glyph runs, cell erases, line scrolls, image blits and background store/restore.
+
+    Glyph codes are kept in a byte heap and images by reference. execute() first drops the
+    operations whose pixels are overwritten later, then replays the rest against a canvas,
+    folding runs of text and scrolling into a single pass over the cells.
+    """
+
+    def __init__(self):
+        self._ops = array('i')
+        self._text = bytearray()
+        self._images: List[Tuple[np.ndarray, Optional[np.ndarray]]] = []
+        self._recorded = 0
+        self._dropped = 0
+        self._folded = 0
+        self._optimize = True
+
+    def __len__(self):
+        return len(self._ops) // FIELDS
+
+    def glyphs(self, x: int, y: int, codes: bytes, fg: int, bg: int):
+        self._ops.extend((OP_GLYPHS, x, y, len(codes) * SIZE, SIZE, len(self._text), len(codes), 0, 0, fg, bg))
+        self._text += codes
+
+    def erase(self, rect: Rect, fg: int, bg: int):
+        """ Blank a rectangle of cells, given in columns and rows """
+        col, row, cols, rows = rect
+        self._ops.extend((OP_ERASE, col * SIZE, row * SIZE, cols * SIZE, rows * SIZE, col, row, cols, rows, fg, bg))
+
+    def scroll(self, count: int, top: int, bottom: int, history: bool, fg: int, bg: int, width: int):
+        """ Scroll rows top..bottom-1 by count lines """
+        self._ops.extend((OP_SCROLL, 0, top * SIZE, width, (bottom - top) * SIZE, count, top, bottom, int(history),
+                          fg, bg))
+
+    def blit(self, x: int, y: int, image: np.ndarray, mask: Optional[np.ndarray], mode: int):
+        """ Draw an image, which must not change until the list is executed """
+        self._ops.extend((OP_BLIT, x, y, image.shape[1], image.shape[0], len(self._images), mode, 0, 0, 0, 0))
+        self._images.append((image, mask))
+
+    def store(self, slot: int, width: int, height: int):
+        self._ops.extend((OP_STORE, 0, 0, width, height, slot, 0, 0, 0, 0, 0))
+
+    def restore(self, slot: int, rect: Rect, full: bool):
+        """ Restore a stored background, all of it (with its cells) if full, else the pixels of rect """
+        self._ops.extend((OP_RESTORE, *rect, slot, int(full), 0, 0, 0, 0))
+
+    def records(self) -> List[Dict]:
+        """ The operations in readable form, for tests and dumps """
+        result = []
+        for op in self._rows():
+            record = {'op': OP_NAMES[op[OP]], 'rect': op[X:A]}
+            if op[OP] == OP_GLYPHS:
+                record['text'] = bytes(self._text[op[A]:op[A] + op[B]])
+            elif op[OP] == OP_BLIT:
+                record['mode'] = op[B]
+            else:
+                record['args'] = op[A:FG]
+            if op[OP] in (OP_GLYPHS, OP_ERASE, OP_SCROLL):
+                record['colors'] = (op[FG], op[BG])
+            result.append(record)
+        return result
+
+    def stats(self) -> Dict[str, int]:
+        """ Operations recorded, dropped as overdraw and executed as part of a folded text run, so far """
+        return {'recorded': self._recorded, 'dropped': self._dropped, 'folded': self._folded}
+
+    def set_optimize(self, optimize: bool):
+        """ Without optimizing, execute() replays every operation as it was recorded """
+        self._optimize = optimize
+
+    def clear(self):
+        del self._ops[:]
+        self._text.clear()
+        self._images.clear()
+
+    def execute(self, canvas: Canvas):
+        """ Optimize and replay the operations on the canvas, then start over with an empty list """
+        if not self._ops:
+            return
+        ops = self._rows()
+        self._recorded += len(ops)
+        if not self._optimize:
+            for op in ops:
+                self._run(canvas, op)
+            self.clear()
+            return
+        live = self._live(ops, canvas)
+        text = canvas.get_font().is_blank(BLANK)
+        segment: List[List[int]] = []
+        region = None
+        for op, alive in zip(ops, live):
+            if not alive:
+                self._dropped += 1
+                continue
+            kind = op[OP]
+            if kind == OP_SCROLL:
+                if region is not None and region != (op[B], op[C]):
+                    self._flush(canvas, segment, region)
+                    segment = []
+                region = (op[B], op[C])
+                segment.append(op)
+            elif (kind == OP_GLYPHS and op[X] % SIZE == 0 and op[Y] % SIZE == 0) or (kind == OP_ERASE and text):
+                segment.append(op)
+            else:
+                self._flush(canvas, segment, region)
+                segment, region = [], None
+                self._run(canvas, op)
+        self._flush(canvas, segment, region)
+        self.clear()
+
+    def _rows(self) -> List[List[int]]:
+        view = np.frombuffer(self._ops, dtype=np.int32)
+        rows = view.reshape(-1, FIELDS).tolist()
+        # Release the buffer, the array can't shrink while numpy looks at it
+        del view
+        return rows
+
+    @staticmethod
+    def _live(ops: List[List[int]], canvas: Canvas) -> List[bool]:
+        """
+        False for operations whose effect is overwritten later: their pixels lie inside a later
+        operation that replaces them, without a store or scroll in between that reads them.
+        Operations that set cells are only dropped for later ones that set the same cells.
+        """
+        width, height = canvas.width(), canvas.height()
+        columns = width // SIZE
+        live = [True] * len(ops)
+        # Cells whose text and pixels are replaced later, and pixel rectangles replaced later without their text
+        covered = bytearray(columns * (height // SIZE))
+        covers: List[Tuple[int, int, int, int]] = []
+        for i in range(len(ops) - 1, -1, -1):
+            op = ops[i]
+            kind = op[OP]
+            if kind == OP_STORE or kind == OP_SCROLL:
+                covered = bytearray(len(covered))
+                covers.clear()
+                continue
+            x0, y0 = max(op[X], 0), max(op[Y], 0)
+            x1, y1 = min(op[X] + op[W], width), min(op[Y] + op[H], height)
+            if x0 >= x1 or y0 >= y1 or (kind == OP_GLYPHS and (x0 != op[X] or y0 != op[Y] or
+                                                               op[X] > width - SIZE or op[Y] > height - SIZE)):
+                # Nothing of it would be drawn
+                live[i] = False
+                continue
+            sets_cells = (kind == OP_ERASE or (kind == OP_RESTORE and op[B] == 1) or
+                          (kind == OP_GLYPHS and op[X] % SIZE == 0 and op[Y] % SIZE == 0))
+            c0, c1 = x0 // SIZE, (x1 + SIZE - 1) // SIZE
+            r0, r1 = y0 // SIZE, (y1 + SIZE - 1) // SIZE
+            if all(covered.find(0, r * columns + c0, r * columns + c1) < 0 for r in range(r0, r1)):
+                live[i] = False
+                continue
+            if not sets_cells:
+                for cx0, cy0, cx1, cy1 in covers:
+                    if cx0 <= x0 and cy0 <= y0 and x1 <= cx1 and y1 <= cy1:
+                        live[i] = False
+                        break
+                else:
+                    if kind != OP_BLIT or op[B] == BLIT_OPAQUE:
+                        # Blended and masked images keep some of the pixels under them
+                        covers.append((x0, y0, x1, y1))
+                        if len(covers) > MAX_COVERS:
+                            del covers[0]
+            else:
+                for r in range(r0, r1):
+                    covered[r * columns + c0:r * columns + c1] = b'\x01' * (c1 - c0)
+        return live
+
+    def _flush(self, canvas: Canvas, segment: List[List[int]], region: Optional[Tuple[int, int]]):
+        """ Execute a run of text operations, in one pass over the cells if it scrolls """
+        if region is None or len(segment) == 1:
+            for op in segment:
+                self._run(canvas, op)
+            return
+        before = canvas.get_cells().copy()
+        right, bottom = canvas.width() - SIZE, canvas.height() - SIZE
+        shift = 0
+        for op in segment:
+            kind = op[OP]
+            if kind == OP_GLYPHS:
+                if 0 <= op[X] <= right and 0 <= op[Y] <= bottom:
+                    canvas.set_cells(op[X], op[Y], self._text[op[A]:op[A] + op[B]], op[FG], op[BG])
+            elif kind == OP_ERASE:
+                canvas.clear_cells((op[A], op[B], op[C], op[D]), op[FG], op[BG])
+            else:
+                shift += canvas.shift_cells(op[A], op[FG], op[BG], op[B], op[C], op[D] == 1)
+        canvas.redraw_cells(before, shift, *region)
+        self._folded += len(segment)
+
+    def _run(self, canvas: Canvas, op: List[int]):
+        kind = op[OP]
+        if kind == OP_GLYPHS:
+            canvas.get_font().draw_run(op[X], op[Y], self._text[op[A]:op[A] + op[B]], op[FG], op[BG])
+        elif kind == OP_ERASE:
+            canvas.erase_cells((op[A], op[B], op[C], op[D]), op[FG], op[BG])
+        elif kind == OP_SCROLL:
+            canvas.scroll_lines(op[A], op[FG], op[BG], op[B], op[C], op[D] == 1)
+        elif kind == OP_BLIT:
+            image, mask = self._images[op[A]]
+            if op[B] == BLIT_OPAQUE:
+                canvas.draw_sub_image(op[X], op[Y], image)
+            elif op[B] == BLIT_MASKED:
+                canvas.draw_masked(op[X], op[Y], image, mask)
+            else:
+                canvas.draw_image(op[X], op[Y], image)
+        elif kind == OP_STORE:
+            canvas.store_background(op[A])
+        elif kind == OP_RESTORE:
+            canvas.restore_background(op[A], None if op[B] == 1 else (op[X], op[Y], op[W], op[H]))
+
+
+class RecordingCanvas:
+    """
+    Stands in for a Canvas while the protocol processes input. Drawing is recorded in a display list,
+    everything else (cursor, colors, sprites, frames...) goes straight to the canvas.
+    """
+
+    def __init__(self, canvas: Canvas, display_list: DisplayList):
+        self._canvas = canvas
+        self._list = display_list
+        # Background slots stored by operations that weren't executed yet
+        self._stored: Set[int] = set()
+
+    def __getattr__(self, name):
+        return getattr(self._canvas, name)
+
+    def get_display_list(self) -> DisplayList:
+        return self._list
+
+    def execute(self):
+        """ Draw what was recorded """
+        self._list.execute(self._canvas)
+        self._stored.clear()
+
+    def draw_glyphs(self, x: int, y: int, codes: bytes):
+        """ A run of glyphs in the current colors """
+        fore, back = self._canvas.get_font().get_colors()
+        self._list.glyphs(x, y, codes, fore, back)
+
+    def erase_cells(self, rect: Rect, fg: int, bg: int):
+        self._list.erase(rect, fg, bg)
+
+    def scroll_lines(self, count: int, fg: int, bg: int,
+                     top: Optional[int] = None, bottom: Optional[int] = None, history: bool = False):
+        # The scroll region may change before the list is executed
+        region_top, region_bottom = self._canvas.get_scroll_region()
+        top = region_top if top is None else top
+        bottom = region_bottom if bottom is None else bottom
+        self._list.scroll(count, top, bottom, history, fg, bg, self._canvas.width())
+
+    def draw_image(self, x: int, y: int, image: np.ndarray):
+        self._list.blit(x, y, image, None, BLIT_BLEND)
+
+    def draw_masked(self, x: int, y: int, image: np.ndarray, mask: np.ndarray):
+        self._list.blit(x, y, image, mask, BLIT_MASKED)
+
+    def draw_sub_image(self, x: int, y: int, image: np.ndarray):
+        self._list.blit(x, y, image, None, BLIT_OPAQUE)
+
+    def store_background(self, slot: int = 0):
+        if 0 <= slot < MAX_BACKGROUND_SLOTS:
+            self._stored.add(slot)
+            self._list.store(slot, self._canvas.width(), self._canvas.height())
+
+    def restore_background(self, slot: int = 0, rect: Optional[Rect] = None):
+        # Restoring a slot that was never stored does nothing, so it isn't recorded
+        if slot in self._stored or self._canvas.has_background(slot):
+            self._list.restore(slot, rect or self._canvas.rect(), rect is None)
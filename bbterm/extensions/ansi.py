@@ -1,69 +1,125 @@
-import re
-from typing import Callable, Dict
+from typing import Callable, List, Optional
 
 from ..inline_font import SIZE
-from PyQt5.QtGui import QColor
-
 from ..canvas import Canvas
 
-_cursor_pattern = r'(\d+);(\d+)'
-_color_pattern = r'(\d+)(?:;(\d+))*'
-_cursor_stack = []
 _colors = [(0, 0, 0), (170, 0, 0), (0, 170, 0), (170, 85, 0),
            (0, 0, 170), (170, 0, 170), (0, 170, 170), (170, 170, 170)]
 
+# Byte classes of the CSI state machine (ESC [ <private> <params> <intermediates> <final>)
+_DIGIT, _SEPARATOR, _PRIVATE, _INTERMEDIATE, _FINAL, _INVALID = range(6)
+_byte_class = bytes(_DIGIT if 0x30 <= b <= 0x39 else
+                    _SEPARATOR if b in (0x3A, 0x3B) else
+                    _PRIVATE if 0x3C <= b <= 0x3F else
+                    _INTERMEDIATE if 0x20 <= b <= 0x2F else
+                    _FINAL if 0x40 <= b <= 0x7E else
+                    _INVALID for b in range(256))
+# Longer sequences are dropped, and larger parameters clamped, like other VT parsers do
+MAX_SEQUENCE_LENGTH = 64
+MAX_PARAMETER = 9999
+
+
+def _count(params: List[int]) -> int:
+    return params[0] if params and params[0] > 0 else 1
+
+
+def _cursor_cell(canvas: Canvas):
+    x, y = canvas.get_cursor()
+    return x // SIZE, y // SIZE
+
+
+def _erase(canvas: Canvas, rect):
+    canvas.erase_cells(rect, *canvas.get_font().get_colors())
+
+
+def clear(canvas: Canvas, params: List[int]):
+    # 0: cursor to end of screen, 1: start of screen to cursor, 2 (or 3): whole screen
+    mode = params[0] if params else 0
+    col, row = _cursor_cell(canvas)
+    cols, rows = canvas.width() // SIZE, canvas.height() // SIZE
+    if mode == 0:
+        _erase(canvas, (col, row, cols - col, 1))
+        _erase(canvas, (0, row + 1, cols, rows - row - 1))
+    elif mode == 1:
+        _erase(canvas, (0, 0, cols, row))
+        _erase(canvas, (0, row, col + 1, 1))
+    else:
+        _erase(canvas, (0, 0, cols, rows))
+
 
-def clear(canvas: Canvas, _: str):
-    # support only full screen clearing
-    canvas.fill(QColor(0, 0, 0))
+def erase_line(canvas: Canvas, params: List[int]):
+    # 0: cursor to end of line, 1: start of line to cursor, 2: whole line
+    mode = params[0] if params else 0
+    col, row = _cursor_cell(canvas)
+    cols = canvas.width() // SIZE
+    if mode == 0:
+        _erase(canvas, (col, row, cols - col, 1))
+    elif mode == 1:
+        _erase(canvas, (0, row, col + 1, 1))
+    else:
+        _erase(canvas, (0, row, cols, 1))
 
 
-def set_cursor(canvas: Canvas, param: str):
-    m = re.match(_cursor_pattern, param)
-    if m:
-        g = m.groups()
-        y = (int(g[0]) - 1) * SIZE
-        x = (int(g[1]) - 1) * SIZE
-        canvas.set_cursor((x, y))
+def _shift_lines(canvas: Canvas, count: int):
+    # Scroll from the cursor line to the bottom of the scroll region, if the cursor is inside it
+    row = _cursor_cell(canvas)[1]
+    top, bottom = canvas.get_scroll_region()
+    if top <= row < bottom:
+        canvas.scroll_lines(count, *canvas.get_font().get_colors(), top=row, bottom=bottom)
 
 
-def move_up(canvas: Canvas, param: str):
-    n = int(param) if param else 1
+def insert_lines(canvas: Canvas, params: List[int]):
+    _shift_lines(canvas, -_count(params))
+
+
+def delete_lines(canvas: Canvas, params: List[int]):
+    _shift_lines(canvas, _count(params))
+
+
+def set_scroll_region(canvas: Canvas, params: List[int]):
+    rows = canvas.height() // SIZE
+    top = params[0] if len(params) > 0 and params[0] > 0 else 1
+    bottom = params[1] if len(params) > 1 and params[1] > 0 else rows
+    canvas.set_scroll_region(top - 1, bottom)
+    canvas.set_cursor((0, 0))
+
+
+def set_cursor(canvas: Canvas, params: List[int]):
+    row = params[0] if len(params) > 0 and params[0] > 0 else 1
+    col = params[1] if len(params) > 1 and params[1] > 0 else 1
+    canvas.set_cursor(((col - 1) * SIZE, (row - 1) * SIZE))
+
+
+def move_up(canvas: Canvas, params: List[int]):
     cursor = canvas.get_cursor()
-    canvas.set_cursor((cursor[0], cursor[1] - n * SIZE))
+    canvas.set_cursor((cursor[0], cursor[1] - _count(params) * SIZE))
 
 
-def move_down(canvas: Canvas, param: str):
-    n = int(param) if param else 1
+def move_down(canvas: Canvas, params: List[int]):
     cursor = canvas.get_cursor()
-    canvas.set_cursor((cursor[0], cursor[1] + n * SIZE))
+    canvas.set_cursor((cursor[0], cursor[1] + _count(params) * SIZE))
 
 
-def move_right(canvas: Canvas, param: str):
-    n = int(param) if param else 1
+def move_right(canvas: Canvas, params: List[int]):
     cursor = canvas.get_cursor()
-    canvas.set_cursor((cursor[0] + n * SIZE, cursor[1]))
+    canvas.set_cursor((cursor[0] + _count(params) * SIZE, cursor[1]))
 
 
-def move_left(canvas: Canvas, param: str):
-    n = int(param) if param else 1
+def move_left(canvas: Canvas, params: List[int]):
     cursor = canvas.get_cursor()
-    canvas.set_cursor((cursor[0] - n * SIZE, cursor[1]))
+    canvas.set_cursor((cursor[0] - _count(params) * SIZE, cursor[1]))
 
 
-def push_cursor(canvas: Canvas, _: str):
-    _cursor_stack.append(canvas.get_cursor())
+def push_cursor(canvas: Canvas, _: List[int]):
+    canvas.push_cursor()
 
 
-def pop_cursor(canvas: Canvas, _: str):
-    if len(_cursor_stack) > 0:
-        canvas.set_cursor(_cursor_stack.pop())
+def pop_cursor(canvas: Canvas, _: List[int]):
+    canvas.pop_cursor()
 
 
-def set_attributes(canvas: Canvas, param: str):
+def set_attributes(canvas: Canvas, values: List[int]):
     font = canvas.get_font()
-    m = re.match(_color_pattern, param)
-    values = [int(c) for c in m.groups() if c is not None]
     if len(values) == 0:
         values = [0]
     color_mod = 0
@@ -72,54 +128,112 @@ def set_attributes(canvas: Canvas, param: str):
             font.set_back_color(0, 0, 0)
             font.set_fore_color(255, 255, 255)
             color_mod = 0
-        if value == 5:
+        elif value == 5:
             canvas.set_blink(True)
-        if value == 25:
+        elif value == 25:
             canvas.set_blink(False)
-        if value == 1:
+        elif value == 1:
             color_mod = 85
-        if 30 <= value <= 37:
+        elif 30 <= value <= 37:
             color = _colors[value - 30]
             font.set_fore_color(color[0] + color_mod, color[1] + color_mod, color[2] + color_mod)
-        if 40 <= value <= 47:
+        elif 40 <= value <= 47:
             color = _colors[value - 40]
             font.set_back_color(color[0] + color_mod, color[1] + color_mod, color[2] + color_mod)
-        if 90 <= value <= 97:
+        elif 90 <= value <= 97:
             color = _colors[value - 90]
             font.set_fore_color(color[0] + 85, color[1] + 85, color[2] + 85)
-        if 100 <= value <= 107:
+        elif 100 <= value <= 107:
             color = _colors[value - 100]
             font.set_back_color(color[0] + 85, color[1] + 85, color[2] + 85)
 
 
 class AnsiExtension:
     def __init__(self):
-        self._codes: Dict[str, Callable[[Canvas, str], None]] = \
-            {'J': clear, 'H': set_cursor, 'A': move_up, 'B': move_down, 'C': move_right,
-             'D': move_left, 's': push_cursor, 'u': pop_cursor, 'm': set_attributes}
+        self._io = None
+        # Dispatch table indexed by the final byte of the sequence
+        self._codes: List[Optional[Callable[[Canvas, List[int]], None]]] = [None] * 256
+        for code, function in {'J': clear, 'K': erase_line, 'L': insert_lines, 'M': delete_lines,
+                               'r': set_scroll_region, 'H': set_cursor, 'A': move_up, 'B': move_down,
+                               'C': move_right, 'D': move_left, 's': push_cursor, 'u': pop_cursor,
+                               'm': set_attributes, 'n': self._device_status, 'c': self._device_attributes}.items():
+            self._codes[ord(code)] = function
+        # State of a sequence that was cut off at the end of the input
+        self._scanned = 2
+        self._params: List[int] = []
+        self._value = -1
+        self._private = 0
 
     @staticmethod
     def get_escape_pattern():
         return '['
 
+    @staticmethod
+    def get_command(data: bytearray, i: int, j: int) -> Optional[str]:
+        """ The final byte of the sequence that ended at j, or None if it was dropped without one """
+        if j - i > 2 and _byte_class[data[j - 1]] == _FINAL:
+            return chr(data[j - 1])
+        return None
+
+    def _device_status(self, canvas: Canvas, params: List[int]):
+        if params == [6] and self._io is not None:
+            cursor = canvas.get_cursor()
+            row = cursor[1] // SIZE + 1
+            col = cursor[0] // SIZE + 1
+            self._io.write(f'\x1b[{row};{col}R'.encode('ascii'))
+
+    def _device_attributes(self, _: Canvas, __: List[int]):
+        if self._io is not None:
+            self._io.write(b'\x1b[?1;0c')
+
+    def reset(self):
+        """ Forget a sequence that was cut off """
+        self._scanned = 2
+        self._params = []
+        self._value = -1
+        self._private = 0
+
     def process(self, canvas: Canvas, data: bytearray, i: int, io=None):
-        n = len(data)
-        for j in range(i + 2, n):
-            code = chr(data[j])
-            if code.isalpha():
-                if code in self._codes:
-                    function = self._codes[code]
-                    sub = data[(i + 2):j]
-                    text = sub.decode('ascii')
-                    function(canvas, text)
-                elif code == 'n' and io is not None:
-                    sub = data[(i + 2):j].decode('ascii')
-                    if sub == '6':
-                        cursor = canvas.get_cursor()
-                        row = cursor[1] // SIZE + 1
-                        col = cursor[0] // SIZE + 1
-                        io.write(f'\x1b[{row};{col}R'.encode('ascii'))
-                elif code == 'c' and io is not None:
-                    io.write(b'\x1b[?1;0c')
+        """
+        Run the CSI state machine from where the previous call stopped.
+        Returns the index after the sequence, or i if it is not complete yet.
+        """
+        n = min(len(data), i + MAX_SEQUENCE_LENGTH)
+        j = i + self._scanned
+        params = self._params
+        value = self._value
+        private = self._private
+        while j < n:
+            b = data[j]
+            kind = _byte_class[b]
+            if kind == _DIGIT:
+                value = (value if value > 0 else 0) * 10 + b - 0x30
+            elif kind == _SEPARATOR:
+                params.append(min(value, MAX_PARAMETER) if value > 0 else 0)
+                value = -1
+            elif kind == _FINAL:
+                if value >= 0 or params:
+                    params.append(min(value, MAX_PARAMETER) if value > 0 else 0)
+                function = self._codes[b]
+                self.reset()
+                # Private (e.g. ESC[?25h) and intermediate (e.g. ESC[0 q) sequences are consumed but not supported
+                if function is not None and private == 0:
+                    self._io = io
+                    function(canvas, params)
                 return j + 1
+            elif kind == _PRIVATE or kind == _INTERMEDIATE:
+                private = b
+            elif kind == _INVALID:
+                # Malformed sequence, drop it and let the protocol handle this byte
+                self.reset()
+                return j
+            j += 1
+        if j - i >= MAX_SEQUENCE_LENGTH:
+            # Too long to be a real sequence, drop it so it can't hold up the input
+            self.reset()
+            return j
+        self._scanned = j - i
+        self._params = params
+        self._value = value
+        self._private = private
         return i
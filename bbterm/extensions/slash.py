@@ -1,18 +1,30 @@
-from typing import Optional, Callable, Dict
+from typing import Callable, Dict
 
-from PyQt5.QtGui import QPixmap
+import numpy as np
 
 from bbterm.debug_utils import diag
 
+from ..compression import decompress, METHOD_RLE
+from ..errors import ProtocolError
 from ..inline_font import SIZE
-from ..sprites import set_sprite, get_sprite
 from ..canvas import Canvas
 
-_saved_background: Optional[QPixmap] = None
-protocol_version: int = 1
+protocol_version: int = 2
 terminal_width: int = 1280
 terminal_height: int = 800
 
+# Capability bits reported in the version negotiation response
+CAP_BULK_SPRITES = 0x0001
+CAP_MULTI_DRAW = 0x0002
+CAP_ZLIB = 0x0004
+CAP_RLE = 0x0008
+CAP_BACKGROUND_SLOTS = 0x0010
+CAP_FRAMES = 0x0020
+capabilities: int = CAP_BULK_SPRITES | CAP_MULTI_DRAW | CAP_ZLIB | CAP_RLE | CAP_BACKGROUND_SLOTS | CAP_FRAMES
+
+# Size of the uncompressed header that precedes the pixels of RLE compressed commands
+_rle_headers = {'S': 2, 'U': 4}
+
 """
 This is an extension protocol for the BBS.
 It is intended for graphical clients
@@ -28,6 +40,11 @@ currently supported commands are:
 - 'B': load background
 - 'S': set sprite image
 - 'D': draw sprite
+- 'U': upload a range of sprite images (capability CAP_BULK_SPRITES)
+- 'M': draw multiple sprites (capability CAP_MULTI_DRAW)
+- 'Z': compressed command (capabilities CAP_ZLIB, CAP_RLE)
+- 'R': restore a rectangle of a stored background (capability CAP_BACKGROUND_SLOTS)
+- 'F': begin/end frame (capability CAP_FRAMES)
 
 <size> is a 2-byte little-endian unsigned integer indicating the size of the payload in bytes.
 
@@ -38,71 +55,158 @@ For capability negotiation, the payload is a 16 bit version number,
 	The server sends this command first to check if the client supports 
 	the protocol, and the client responds with the same command if it does.
 	The client can ignore the server width,height, and use its own dimensions in the response.
+	From version 2, the response has a 16 bit capability mask after width and height,
+	and the server should only use optional commands whose capability bit is set.
 For set cursor, the payload is: x (2 bytes), y (2 bytes)   (in pixels, not character cells)
-For store/load background, the payload is empty
-For set sprite image, the payload is: sprite_id (2 bytes), image data (32*32*4 bytes, RGBA image)
+For store/load background, the payload is empty, or with CAP_BACKGROUND_SLOTS a slot number (1 byte).
+	An empty payload is slot 0. Slots 0-7 are available.
+For restore background rectangle, the payload is: slot (1 byte), x, y, width, height (2 bytes each, in pixels)
+For begin/end frame, the payload is 1 to begin a frame and 0 to end it (1 byte).
+	The client doesn't repaint while a frame is open, so the commands between begin and end
+	are shown together. A frame that isn't ended is shown after a short timeout.
+For set sprite image, the payload is: sprite_id (2 bytes), image data (32*32*4 bytes, RGBA image,
+	or 32*32*3 bytes RGB image where black is transparent)
 For draw sprite, the payload is: sprite_id (2 bytes) (drawn at current cursor position)
+For upload sprites, the payload is: first sprite_id (2 bytes), count (2 bytes), followed by
+	count images for consecutive sprite ids, all either RGB (32*32*3 bytes, black is transparent)
+	or RGBA (32*32*4 bytes)
+For draw multiple sprites, the payload is a list of: sprite_id (2 bytes), x (2 bytes), y (2 bytes)
+	(in pixels). The cursor is not moved.
+For compressed command, the payload is: method (1 byte), command (1 byte), compressed payload.
+	The decompressed payload is processed as the payload of <command>, and is not limited to 64KB.
+	Method 1 (CAP_ZLIB) is a zlib stream, and can wrap any command.
+	Method 2 (CAP_RLE) is for the color keyed RGB images of 'S' and 'U': the command header
+	(sprite_id, or first sprite_id and count) is sent as is, followed by runs of pixels.
+	Each run starts with a control byte c. If bit 7 is set, (c & 0x7F) + 1 transparent pixels follow.
+	Otherwise if bit 6 is set, one RGB pixel (3 bytes) follows and is repeated (c & 0x3F) + 1 times,
+	else (c & 0x3F) + 1 literal RGB pixels follow.
 """
 
 
-def set_cursor(canvas: Canvas, data: bytes):
+def set_cursor(canvas: Canvas, data: memoryview):
 	if len(data) == 4:
 		x = data[0] | (data[1] << 8)
 		y = data[2] | (data[3] << 8)
 		canvas.set_cursor((x, y))
 
 
-def set_sprite_pixels(_: Canvas, data: bytes):
-	if len(data) == (2 + SIZE * SIZE * 4):
+def set_sprite_pixels(canvas: Canvas, data: memoryview):
+	if len(data) in (2 + SIZE * SIZE * 3, 2 + SIZE * SIZE * 4):
 		index = (data[1] << 8) | data[0]
-		diag(f"Setting sprite {index}")
-		set_sprite(index, data[2:])
+		diag("Setting sprite %d", index)
+		canvas.set_sprite(index, data[2:])
 	else:
-		diag(f"Sprite data size incorrect {len(data)}")
+		diag("Sprite data size incorrect %d", len(data))
 
 
-def draw_sprite(canvas: Canvas, data: bytes):
+def draw_sprite(canvas: Canvas, data: memoryview):
 	if len(data) == 2:
 		index = (data[1] << 8) | data[0]
-		sprite = get_sprite(index)
+		sprite = canvas.get_sprite(index)
 		if sprite:
 			cursor = canvas.get_cursor()
-			canvas.draw_image(cursor[0], cursor[1], sprite.get_image())
-
-
-def version_negotiation(_: Canvas, data: bytes, io):
-	if len(data) == 6 and io is not None:
-		# Respond with our client protocol version
-		response = bytearray(11)
-		response[0:5] = b'\x1b/V\x06\x00'
+			sprite.draw(canvas, cursor[0], cursor[1])
+
+
+def upload_sprites(canvas: Canvas, data: memoryview):
+	if len(data) >= 4:
+		first = data[0] | (data[1] << 8)
+		count = data[2] | (data[3] << 8)
+		step = (len(data) - 4) // count if count > 0 else 0
+		if step in (SIZE * SIZE * 3, SIZE * SIZE * 4) and step * count == len(data) - 4:
+			for k in range(count):
+				canvas.set_sprite((first + k) & 0xFFFF, data[4 + k * step:4 + (k + 1) * step])
+			return
+	diag("Sprite upload size incorrect %d", len(data))
+
+
+def draw_sprites(canvas: Canvas, data: memoryview):
+	if len(data) % 6 == 0:
+		for index, x, y in np.frombuffer(data, dtype='<u2').reshape(-1, 3).tolist():
+			sprite = canvas.get_sprite(index)
+			if sprite:
+				sprite.draw(canvas, x, y)
+
+
+def version_negotiation(_: Canvas, data: memoryview, io):
+	if len(data) >= 6 and io is not None:
+		# Respond with our client protocol version and capabilities
+		response = bytearray(13)
+		response[0:5] = b'\x1b/V\x08\x00'
 		response[5:7] = protocol_version.to_bytes(2, 'little')
 		response[7:9] = terminal_width.to_bytes(2, 'little')
 		response[9:11] = terminal_height.to_bytes(2, 'little')
+		response[11:13] = capabilities.to_bytes(2, 'little')
 		io.write(response)
 
 
 # Store background
-def store_background(canvas: Canvas, _: bytes):
-	global _saved_background
-	_saved_background = canvas.get_pixmap().copy()
+def store_background(canvas: Canvas, data: memoryview):
+	if len(data) <= 1:
+		canvas.store_background(data[0] if len(data) == 1 else 0)
 
 
 # Load background
-def load_background(canvas: Canvas, _: bytes):
-	if _saved_background is not None:
-		canvas.copy_from(_saved_background)
+def load_background(canvas: Canvas, data: memoryview):
+	if len(data) <= 1:
+		canvas.restore_background(data[0] if len(data) == 1 else 0)
+
+
+# Restore a rectangle of a stored background
+def restore_background_rect(canvas: Canvas, data: memoryview):
+	if len(data) == 9:
+		x = data[1] | (data[2] << 8)
+		y = data[3] | (data[4] << 8)
+		w = data[5] | (data[6] << 8)
+		h = data[7] | (data[8] << 8)
+		canvas.restore_background(data[0], (x, y, w, h))
+
+
+def frame(canvas: Canvas, data: memoryview):
+	if len(data) == 1:
+		if data[0]:
+			canvas.begin_frame()
+		else:
+			canvas.end_frame()
 
 
 class SlashExtension:
 	def __init__(self):
-		self._codes: Dict[str, Callable[[Canvas, bytes], None]] \
+		self._codes: Dict[str, Callable[[Canvas, memoryview], None]] \
 			= {'H': set_cursor, 'A': store_background,
-			   'B': load_background, 'D': draw_sprite, 'S': set_sprite_pixels}
+			   'B': load_background, 'D': draw_sprite, 'S': set_sprite_pixels,
+			   'U': upload_sprites, 'M': draw_sprites, 'R': restore_background_rect,
+			   'F': frame}
 
 	@staticmethod
 	def get_escape_pattern():
 		return '/'
 
+	@staticmethod
+	def get_command(data: bytearray, i: int, _: int) -> str:
+		""" The code of the command that started at i """
+		return chr(data[i + 2])
+
+	def reset(self):
+		# Commands are only processed once they are complete, so there is nothing to forget
+		pass
+
+	@staticmethod
+	def _decompress(payload: memoryview):
+		if len(payload) >= 2:
+			method = payload[0]
+			code = chr(payload[1])
+			header = _rle_headers.get(code)
+			if method != METHOD_RLE or header is not None:
+				try:
+					data = decompress(method, payload[2:], header)
+					if data is not None and code != 'Z':
+						return code, data
+				except ProtocolError as e:
+					diag(e.text)
+		diag("Invalid compressed slash command")
+		return None, None
+
 	def process(self, canvas: Canvas, data: bytearray, i: int, io=None):
 		"""
 		Process a single command, if enough data is available. 
@@ -114,14 +218,17 @@ class SlashExtension:
 			payload_size = (data[i + 4] << 8) | data[i + 3]
 			if n < (5 + payload_size):
 				return i
-			payload = data[(i + 5):(i + 5 + payload_size)]
-			if code in self._codes:
-				function = self._codes[code]
-				function(canvas, payload)
-			elif code == 'V':
-				version_negotiation(canvas, payload, io)
-			else:
-				# Ignore unknown command, but skip it to avoid desync
-				diag(f"Unknown slash command: {code}")
+			# Handlers get a zero-copy view of the payload, and must copy anything they keep
+			with memoryview(data) as view, view[(i + 5):(i + 5 + payload_size)] as payload:
+				if code == 'Z':
+					code, payload = self._decompress(payload)
+				if code in self._codes:
+					function = self._codes[code]
+					function(canvas, payload)
+				elif code == 'V':
+					version_negotiation(canvas, payload, io)
+				elif code is not None:
+					# Ignore unknown command, but skip it to avoid desync
+					diag("Unknown slash command: %s", code)
 			i += payload_size + 5
 		return i
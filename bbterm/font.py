@@ -1,79 +1,116 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
 import numpy as np
-from PyQt5.QtCore import QRect
-from PyQt5.QtGui import QImage
-from .inline_font import SIZE, load_font
+from .inline_font import SIZE, load_glyphs, split_glyphs
 
 
 # from .canvas import Canvas
 
+GLYPH_CACHE_BUDGET = 8 * 1024 * 1024
+
+
+class GlyphCache:
+    """
+    LRU cache of pre-colored glyph tiles, keyed by (glyph, foreground, background).
+    Tiles are read-only RGBA arrays ready to be copied onto the canvas.
+    """
+
+    def __init__(self, budget: int = GLYPH_CACHE_BUDGET):
+        self._tiles: OrderedDict = OrderedDict()
+        self._capacity = max(1, budget // (SIZE * SIZE * 4))
+
+    def __len__(self):
+        return len(self._tiles)
+
+    def get(self, key: Tuple[int, int, int]):
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+        return tile
+
+    def put(self, key: Tuple[int, int, int], tile: np.ndarray):
+        tile.flags.writeable = False
+        self._tiles[key] = tile
+        if len(self._tiles) > self._capacity:
+            self._tiles.popitem(last=False)
+
+    def clear(self):
+        self._tiles.clear()
+
+
+def _rgba(color: int) -> np.ndarray:
+    return np.array([(color >> 16) & 255, (color >> 8) & 255, color & 255, 255], dtype=np.uint8)
+
 
 class Font:
-    def __init__(self, image, canvas):
+    def __init__(self, image: np.ndarray, canvas):
         self._width = SIZE
         self._height = SIZE
         self._canvas = canvas
-        self._canvas_rect = canvas.rect()
-        if isinstance(image, np.ndarray):
-            if len(image.shape) == 2:
-                hh, ww = image.shape
-                c = 3
-                # convert to rgb
-                rgb = np.ndarray((hh, ww, 3), dtype=np.uint8)
-                for y in range(hh):
-                    for x in range(ww):
-                        rgb[y, x, :] = image[y, x]
-                image = rgb
-            else:
-                hh, ww, c = image.shape
-            data = image.data
-            if not isinstance(data, bytes):
-                data = data.tobytes()
-            image = QImage(data, ww, hh, ww * c, QImage.Format_RGB888)
-        self._image: QImage = image.convertToFormat(QImage.Format.Format_Indexed8)
-        self._colors = self._image.colorTable()
-        self._rects = []
-        self._image_rect = QRect(0, 0, image.width(), image.height())
-        # row_width = (self._image.width() // w)
-        for y in range(0, self._image.height(), self._height):
-            for x in range(0, self._image.width(), self._width):
-                self._rects.append(QRect(x, y, self._width, self._height))
+        self._canvas_width = canvas.width()
+        self._canvas_height = canvas.height()
+        # Either a font atlas image, or glyph masks that were already split
+        self._glyphs = image if len(image.shape) == 4 else split_glyphs(image)
+        self._back_key = 0x000000
+        self._fore_key = 0xFFFFFF
+        self._cache = GlyphCache()
 
     def get_canvas(self):
         return self._canvas
 
     def right_most(self):
-        return self._canvas_rect.width() - SIZE
+        return self._canvas_width - SIZE
 
     def bottom_most(self):
-        return self._canvas_rect.height() - SIZE
+        return self._canvas_height - SIZE
+
+    def get_colors(self) -> Tuple[int, int]:
+        """ The foreground and background colors as 0xRRGGBB """
+        return self._fore_key, self._back_key
 
-    def scroll(self):
-        self._canvas.scroll(0, SIZE)
+    def is_blank(self, index: int) -> bool:
+        """ True if the glyph has no foreground pixels """
+        return not self._glyphs[index].any()
 
     def set_back_color(self, r: int, g: int, b: int):
         if 255 >= r >= 0 and 255 >= g >= 0 and 255 >= b >= 0:
-            self._colors[0] = 0xFF000000 | (r << 16) | (g << 8) | b
-            self._image.setColorTable(self._colors)
+            self._back_key = (r << 16) | (g << 8) | b
 
     def set_fore_color(self, r: int, g: int, b: int):
         if 255 >= r >= 0 and 255 >= g >= 0 and 255 >= b >= 0:
-            self._colors[1] = 0xFF000000 | (r << 16) | (g << 8) | b
-            self._image.setColorTable(self._colors)
+            self._fore_key = (r << 16) | (g << 8) | b
 
-    def draw_char(self, x: int, y: int, index: int):
-        if index >= len(self._rects):
+    def draw_run(self, x: int, y: int, codes: bytes, fore: Optional[int] = None, back: Optional[int] = None):
+        """
+        Draw a run of glyphs left to right with a single canvas blit, skipping cells that are already on screen.
+        The colors (0xRRGGBB) default to the current ones.
+        """
+        if not codes or x < 0 or y < 0 or x > self.right_most() or y > self.bottom_most():
             return
-        target = QRect(x, y, self._width, self._height)
-        if not self._canvas_rect.contains(target, False):
+        fore = self._fore_key if fore is None else fore
+        back = self._back_key if back is None else back
+        start, end = self._canvas.changed_cells(x, y, codes, fore, back)
+        if start == end:
             return
-        source = self._rects[index]
-        self._canvas.draw_sub_image(target, self._image, source)
+        if end - start < len(codes):
+            codes = codes[start:end]
+            x += start * SIZE
+        tiles = [self._tile(c, fore, back) for c in codes]
+        self._canvas.draw_sub_image(x, y, tiles[0] if len(tiles) == 1 else np.concatenate(tiles, axis=1))
+        self._canvas.set_cells(x, y, codes, fore, back)
+
+    def render_cells(self, cells: np.ndarray) -> np.ndarray:
+        """ Render a row of text cells to RGBA pixels """
+        return np.concatenate([self._tile(ch, fg, bg) for ch, fg, bg, _ in cells.tolist()], axis=1)
 
-    def draw_text(self, x: int, y: int, text: str):
-        for c in text:
-            self.draw_char(x, y, ord(c))
-            x += self._width
+    def _tile(self, index: int, fore: int, back: int) -> np.ndarray:
+        key = (index, fore, back)
+        tile = self._cache.get(key)
+        if tile is None:
+            tile = np.where(self._glyphs[index], _rgba(fore), _rgba(back))
+            self._cache.put(key, tile)
+        return tile
 
 
 def create_font(target_canvas):
-    return Font(load_font(), target_canvas)
+    return Font(load_glyphs(), target_canvas)
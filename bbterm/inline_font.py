@@ -1,5 +1,8 @@
 import numpy as np
 import base64
+import hashlib
+import os
+import sys
 
 # noinspection SpellCheckingInspection
 font_data = '''AAAAAPD//w/w//8P8A//AADwAAAA/w8AAPAAAAAAAAD/////AAAAAP////8AAP//
@@ -690,18 +693,55 @@ SIZE = 32
 
 
 def load_font():
-    data = base64.b64decode(''.join(font_data.split('\n')))
-    image = np.ndarray((256, 1024), dtype=np.uint8)
-    image.fill(0)
-    index = 0
-    for i in range(image.shape[0]):
-        for j in range(image.shape[1]):
-            k = j & 7
-            if data[index] & (1 << k) != 0:
-                image[i, j] = 255
-            if k == 7:
-                index += 1
-    return image
+    data = np.frombuffer(base64.b64decode(''.join(font_data.split('\n'))), dtype=np.uint8)
+    # Each byte holds 8 horizontal pixels, least significant bit first
+    bits = np.unpackbits(data, bitorder='little')[:256 * 1024]
+    return bits.reshape(256, 1024) * np.uint8(255)
+
+
+def split_glyphs(image: np.ndarray) -> np.ndarray:
+    """ Split a font atlas into one boolean SIZExSIZEx1 mask per glyph, in row major order """
+    if len(image.shape) == 3:
+        image = image[:, :, 0]
+    rows = image.shape[0] // SIZE
+    cols = image.shape[1] // SIZE
+    image = image[:rows * SIZE, :cols * SIZE]
+    return (image.reshape(rows, SIZE, cols, SIZE)
+            .swapaxes(1, 2)
+            .reshape(rows * cols, SIZE, SIZE, 1) > 127)
+
+
+def cache_dir() -> str:
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+    return os.path.join(base, 'bbterm')
+
+
+def load_glyphs() -> np.ndarray:
+    """
+    Return the split glyph masks of the built-in font.
+    They are cached on disk, keyed by a hash of font_data, and memory mapped on later starts.
+    """
+    key = hashlib.sha1(font_data.encode('ascii')).hexdigest()[:16]
+    path = os.path.join(cache_dir(), f'font-{key}.npy')
+    try:
+        glyphs = np.load(path, mmap_mode='r')
+        if glyphs.dtype == np.bool_ and glyphs.shape == (256, SIZE, SIZE, 1):
+            return glyphs
+    except (OSError, ValueError):
+        pass
+    glyphs = split_glyphs(load_font())
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, glyphs)
+        os.replace(temp, path)
+    except OSError:
+        pass  # Read-only home, just use the decoded font
+    return glyphs
 
 
 def show():
@@ -1,20 +1,26 @@
 #!/usr/bin/env python3
+import json
+import math
 import os
 import socket
 import sys
 import time
 import argh
 import threading
-from typing import Optional
+from typing import Dict, List, Optional, Tuple, Union
+import numpy as np
 
 os.environ["QT_QPA_PLATFORM"] = "wayland"
 
-from PyQt5.QtCore import QTimer, QSize, Qt
-from PyQt5.QtGui import QPaintEvent, QPainter, QResizeEvent, QKeyEvent
-from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget
+from PyQt5.QtCore import pyqtSignal, QObject, QTimer, QSize, Qt, QSocketNotifier, QRect, QRectF
+from PyQt5.QtGui import QCloseEvent, QColor, QFont, QFontMetrics, QPaintEvent, QPainter, QResizeEvent, QShowEvent, QKeyEvent, QImage, QRegion
+from PyQt5.QtWidgets import QApplication, QMainWindow, QStackedWidget, QTabBar, QVBoxLayout, QWidget
 from .canvas import Canvas
 from .font import SIZE
-from .protocol import ClientProtocol
+from .metrics import Metrics
+from .pipeline import MAX_BATCHES, ParseWorker
+from .scrollback import DEFAULT_SCROLLBACK_LINES
+from .session import Session
 from .telnet_client import TelnetClient
 
 key_map = {
@@ -33,15 +39,40 @@ key_map = {
     Qt.Key_End: b'\x1b[F'
 }
 
-terminating = False
+BLINK_INTERVAL = 500  # ms, also how often the metrics overlay is refreshed
+POLL_INTERVAL = 10  # ms, for streams that can't be waited on
+
+
+def pixels_image(pixels: np.ndarray) -> QImage:
+    # Zero-copy view of an RGBA pixel array, valid while the array is alive
+    return QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], QImage.Format_RGBX8888)
 
 
 class CanvasWidget(QWidget):
-    def __init__(self, parent: QWidget):
+    def __init__(self, parent: QWidget, canvas: Canvas, integer_scaling: bool = False,
+                 metrics: Optional[Metrics] = None):
         super().__init__(parent)
-        self._canvas = Canvas(SIZE * 40, SIZE * 25)
+        self._canvas = canvas
+        self._metrics = metrics
+        self._last_paint = 0.0
+        # Lines of text shown over the top right corner of the screen
+        self._overlay: List[str] = []
+        self._overlay_font = QFont('monospace', 10)
+        self._overlay_font.setStyleHint(QFont.TypeWriter)
         self._text_line_width = self._canvas.width() // SIZE
         self._scaling = 1
+        self._integer_scaling = integer_scaling
+        # The canvas scaled to the window, painted without any transform. None when the scale is 1
+        self._presented: Optional[np.ndarray] = None
+        self._source_rows: Optional[np.ndarray] = None
+        self._source_cols: Optional[np.ndarray] = None
+        # Lines scrolled back into the history, 0 shows the live screen
+        self._history_offset = 0
+        self._history_total = 0
+        self._history_view: Optional[np.ndarray] = None
+        self._frame_timer = QTimer(self)
+        self._frame_timer.setSingleShot(True)
+        self._frame_timer.timeout.connect(self.update_damage)
         self.set_window_size(parent.size())
 
     def get_canvas(self):
@@ -50,9 +81,137 @@ class CanvasWidget(QWidget):
     def set_window_size(self, size: QSize):
         width_scaling = size.width() / self.width()
         height_scaling = size.height() / self.height()
-        self._scaling = min(width_scaling, height_scaling)
+        scaling = min(width_scaling, height_scaling)
+        if self._integer_scaling or abs(scaling - round(scaling)) < 1e-6:
+            scaling = max(1, math.floor(scaling + 1e-6))
+        self._scaling = scaling
+        # Hidden widgets catch up when they are shown
+        if self.isVisible():
+            self._rebuild_presentation()
+            self.update()
+
+    def refresh(self):
+        """ Present the whole canvas again, after the session was drawing while not on screen """
+        self._canvas.take_damage()
+        self._update_history_view()
+        self._rebuild_presentation()
         self.update()
 
+    def _source_pixels(self) -> np.ndarray:
+        pixels = self._canvas.get_pixels() if self._history_view is None else self._history_view
+        return pixels.view(np.uint32).reshape(pixels.shape[:2])
+
+    def _rebuild_presentation(self):
+        s = self._scaling
+        if s == 1:
+            self._presented = None
+            return
+        w, h = round(self.width() * s), round(self.height() * s)
+        # Nearest neighbour source row and column for every presented pixel
+        self._source_rows = np.minimum((np.arange(h) / s).astype(np.intp), self.height() - 1)
+        self._source_cols = np.minimum((np.arange(w) / s).astype(np.intp), self.width() - 1)
+        self._presented = np.empty((h, w, 4), dtype=np.uint8)
+        self._present(0, 0, self.width(), self.height())
+
+    def _present(self, x: int, y: int, w: int, h: int) -> QRect:
+        """ Refresh the presentation cache for a rectangle of the canvas. Returns the widget area updated """
+        presented = self._presented.view(np.uint32).reshape(self._presented.shape[:2])
+        source = self._source_pixels()
+        s = self._scaling
+        if isinstance(s, int):
+            # Whole canvas pixels become s x s blocks
+            x0, y0 = max(x, 0), max(y, 0)
+            x1, y1 = min(x + w, self.width()), min(y + h, self.height())
+            if x0 >= x1 or y0 >= y1:
+                return QRect()
+            target = presented[y0 * s:y1 * s, x0 * s:x1 * s].reshape(y1 - y0, s, x1 - x0, s)
+            target[...] = source[y0:y1, x0:x1, np.newaxis][:, np.newaxis]
+            return QRect(x0 * s, y0 * s, (x1 - x0) * s, (y1 - y0) * s)
+        # The presented pixels whose nearest source pixel is inside the rectangle
+        x0, x1 = np.searchsorted(self._source_cols, (x, x + w)).tolist()
+        y0, y1 = np.searchsorted(self._source_rows, (y, y + h)).tolist()
+        if x0 >= x1 or y0 >= y1:
+            return QRect()
+        rows = np.take(source, self._source_rows[y0:y1], axis=0)
+        presented[y0:y1, x0:x1] = np.take(rows, self._source_cols[x0:x1], axis=1)
+        return QRect(x0, y0, x1 - x0, y1 - y0)
+
+    def scroll_history(self, lines: int):
+        """ Move the view back (positive) or forward (negative) in the scrollback, without touching the session """
+        scrollback = self._canvas.get_scrollback()
+        offset = max(0, min(self._history_offset + lines, len(scrollback)))
+        if offset != self._history_offset:
+            self._history_offset = offset
+            self._history_total = scrollback.total()
+            self._update_history_view()
+            self._rebuild_presentation()
+            self.update()
+
+    def page_lines(self) -> int:
+        return self.height() // SIZE - 1
+
+    def _update_history_view(self):
+        scrollback = self._canvas.get_scrollback()
+        if self._history_offset > 0:
+            # Keep showing the same lines while new ones scroll off the live screen
+            self._history_offset = min(self._history_offset + scrollback.total() - self._history_total,
+                                       len(scrollback))
+            self._history_total = scrollback.total()
+            self._history_view = scrollback.render(self._canvas.get_font(), self._history_offset,
+                                                   self._canvas.get_pixels())
+        else:
+            self._history_view = None
+
+    def update_damage(self):
+        # Schedule a repaint of only the canvas areas that changed, in widget coordinates
+        remaining = self._canvas.frame_remaining()
+        if remaining > 0:
+            # Hold the damage while the server is drawing a frame, the timer covers a lost end of frame
+            if not self._frame_timer.isActive():
+                self._frame_timer.start(math.ceil(remaining * 1000))
+            return
+        self._frame_timer.stop()
+        start = time.perf_counter()
+        if self._history_view is not None:
+            # The visible part of the live screen moved, so redraw the whole history view
+            if self._canvas.take_damage():
+                self._update_history_view()
+                self._rebuild_presentation()
+                self.update()
+            return
+        region = QRegion()
+        for x, y, w, h in self._canvas.take_damage():
+            if self._presented is not None:
+                region = region.united(self._present(x, y, w, h))
+            else:
+                region = region.united(QRect(x, y, w, h))
+        if not region.isEmpty():
+            self.update(region)
+            if self._metrics is not None:
+                self._metrics.sample('present_ms', (time.perf_counter() - start) * 1000)
+
+    def set_overlay(self, lines: List[str]):
+        if lines != self._overlay:
+            self.update(self._overlay_rect())
+            self._overlay = lines
+            self.update(self._overlay_rect())
+
+    def _overlay_rect(self) -> QRect:
+        if not self._overlay:
+            return QRect()
+        metrics = QFontMetrics(self._overlay_font)
+        w = max(metrics.horizontalAdvance(line) for line in self._overlay) + 12
+        h = metrics.lineSpacing() * len(self._overlay) + 8
+        return QRect(round(self.width() * self._scaling) - w, 0, w, h)
+
+    def resizeEvent(self, e: QResizeEvent) -> None:
+        super().resizeEvent(e)
+        self.set_window_size(e.size())
+
+    def showEvent(self, e: QShowEvent) -> None:
+        super().showEvent(e)
+        self.refresh()
+
     def width(self):
         return self._canvas.width()
 
@@ -60,36 +219,306 @@ class CanvasWidget(QWidget):
         return self._canvas.height()
 
     def paintEvent(self, e: QPaintEvent):
+        start = time.perf_counter()
         qp = QPainter(self)
-        qp.scale(self._scaling, self._scaling)
-        qp.drawPixmap(0, 0, self._canvas.get_pixmap())
+        history = self._history_view
+        # The presented pixels are already at window scale, so painting is a plain blit
+        if self._presented is not None:
+            image = pixels_image(self._presented)
+        else:
+            image = pixels_image(self._canvas.get_pixels() if history is None else history)
+        bounds = image.rect()
+        for r in e.region().rects():
+            r = r.intersected(bounds)
+            if not r.isEmpty():
+                qp.drawImage(r.topLeft(), image, r)
+        s = self._scaling
+        overlay = self._canvas.get_cursor_overlay()
+        if overlay is not None and history is None:
+            # Invert the cursor cell on screen, the canvas pixels stay untouched
+            x, y, w, h = overlay
+            qp.setCompositionMode(QPainter.CompositionMode_Difference)
+            qp.fillRect(QRectF(x * s, y * s, w * s, h * s), Qt.white)
+        if self._overlay:
+            rect = self._overlay_rect()
+            qp.setCompositionMode(QPainter.CompositionMode_SourceOver)
+            qp.fillRect(rect, QColor(0, 0, 0, 192))
+            qp.setPen(Qt.white)
+            qp.setFont(self._overlay_font)
+            qp.drawText(rect.adjusted(6, 4, -6, -4), Qt.AlignLeft | Qt.AlignTop, '\n'.join(self._overlay))
+        qp.end()
+        if self._metrics is not None:
+            self._metrics.count('paints')
+            self._metrics.sample('paint_ms', (time.perf_counter() - start) * 1000)
+            if self._last_paint:
+                self._metrics.sample('frame_interval_ms', (start - self._last_paint) * 1000)
+            self._last_paint = start
+
+
+class SessionChannel(QObject):
+    """ Moves data between one session's stream and its widget, driven by the window's event loop """
+
+    def __init__(self, parent: QObject, session: Session, widget: CanvasWidget):
+        super().__init__(parent)
+        self._session = session
+        self._widget = widget
+        self._io = session.get_io()
+        self._protocol = session.get_protocol()
+        self._backlog_scheduled = False
+        self._flush_scheduled = False
+        self._read_notifier: Optional[QSocketNotifier] = None
+        self._write_notifier: Optional[QSocketNotifier] = None
+        try:
+            fd = self._io.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is not None:
+            # Wake up only when the socket has data
+            self._read_notifier = QSocketNotifier(fd, QSocketNotifier.Read, self)
+            self._read_notifier.activated.connect(self._on_readable)
+            if hasattr(self._io, 'output_queue_depth'):
+                # Watched only while output is queued that the socket didn't take
+                self._write_notifier = QSocketNotifier(fd, QSocketNotifier.Write, self)
+                self._write_notifier.setEnabled(False)
+                self._write_notifier.activated.connect(self._flush_output)
+
+    def get_session(self) -> Session:
+        return self._session
+
+    def get_widget(self) -> CanvasWidget:
+        return self._widget
+
+    def needs_polling(self) -> bool:
+        """ True for streams without a file descriptor, which are read on the window's poll timer """
+        return self._read_notifier is None
+
+    def _on_readable(self):
+        self._backlog_scheduled = False
+        self.poll()
+        # Stop watching the socket while the parser is behind, and finish the backlog on a later turn
+        self._read_notifier.setEnabled(self._session.is_connected() and self._protocol.wants_input())
+        if self._protocol.has_backlog() and not self._backlog_scheduled:
+            self._backlog_scheduled = True
+            QTimer.singleShot(0, self._on_readable)
+
+    def poll(self):
+        if self._protocol.process():
+            # Sessions in background tabs keep their damage until they are shown
+            if self._widget.isVisible():
+                self._widget.update_damage()
+            # The server may have asked for a reply
+            self.schedule_flush()
+
+    def write(self, data: bytes):
+        self._io.write(data)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        # Everything written during this event loop turn goes out together
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            QTimer.singleShot(0, self._flush_output)
+
+    def _flush_output(self):
+        self._flush_scheduled = False
+        self._io.flush()
+        if self._write_notifier is not None:
+            self._write_notifier.setEnabled(self._session.is_connected() and self._io.output_queue_depth() > 0)
+
+    def close(self):
+        for notifier in (self._read_notifier, self._write_notifier):
+            if notifier is not None:
+                notifier.setEnabled(False)
+
+
+class ThreadedSessionChannel(QObject):
+    """ A session read and parsed by a ParseWorker thread. The GUI thread only applies its render batches """
+
+    batch_ready = pyqtSignal()
+
+    def __init__(self, parent: QObject, session: Session, worker: ParseWorker, widget: CanvasWidget):
+        super().__init__(parent)
+        self._session = session
+        self._worker = worker
+        self._widget = widget
+        self._apply_scheduled = False
+        # Emitted on the worker thread, delivered on this one
+        self.batch_ready.connect(self._apply_batches)
+        worker.start(self.batch_ready.emit)
+
+    def get_session(self) -> Session:
+        return self._session
+
+    def get_widget(self) -> CanvasWidget:
+        return self._widget
+
+    def get_worker(self) -> ParseWorker:
+        return self._worker
+
+    def needs_polling(self) -> bool:
+        return False
+
+    def _apply_batches(self):
+        self._apply_scheduled = False
+        canvas = self._widget.get_canvas()
+        applied = False
+        # No more than a queue's worth per turn, so a busy worker can't keep the GUI from handling input
+        for _ in range(MAX_BATCHES):
+            batch = self._worker.take_batch()
+            if batch is None:
+                break
+            batch.apply(canvas)
+            applied = True
+        if applied and self._widget.isVisible():
+            self._widget.update_damage()
+        if self._worker.pending() > 0 and not self._apply_scheduled:
+            self._apply_scheduled = True
+            QTimer.singleShot(0, self._apply_batches)
+
+    def write(self, data: bytes):
+        self._worker.send(data)
+
+    def close(self):
+        self._worker.stop()
+
+
+Channel = Union[SessionChannel, ThreadedSessionChannel]
 
 
 class MainWindow(QMainWindow):
-    def __init__(self, io):
+    """
+    One tab per session, all of them serviced by the Qt event loop of this window.
+    With threaded set, each session is read and parsed on a worker thread instead.
+    """
+
+    def __init__(self, sessions: List[Session], integer_scaling: bool = False, threaded: bool = False):
         super().__init__()
-        self._main_widget = CanvasWidget(self)
-        self._io = io
-        self._protocol: Optional[ClientProtocol] = ClientProtocol(io, self._main_widget.get_canvas())
-        self.setMinimumSize(1280, 800)
-        self.setCentralWidget(self._main_widget)
-        self._read_timer = QTimer(self)
-        self._read_timer.timeout.connect(self._on_read_timer)
-        self._read_timer.start(10)
+        central = QWidget(self)
+        self._tabs = QTabBar(central)
+        # Keys belong to the BBS, so nothing in the window takes the focus from it
+        self._tabs.setFocusPolicy(Qt.NoFocus)
+        self._tabs.setAutoHide(True)
+        self._tabs.setDocumentMode(True)
+        self._screens = QStackedWidget(central)
+        self._channels: List[Channel] = []
+        self._show_metrics = False
+        for index, session in enumerate(sessions):
+            worker = ParseWorker(session) if threaded else None
+            canvas = worker.create_display() if worker is not None else session.get_canvas()
+            widget = CanvasWidget(self._screens, canvas, integer_scaling, session.get_metrics())
+            widget.setMinimumSize(1280, 800)
+            self._screens.addWidget(widget)
+            self._tabs.addTab(session.get_name() or f'Session {index + 1}')
+            if worker is not None:
+                self._channels.append(ThreadedSessionChannel(self, session, worker, widget))
+            else:
+                self._channels.append(SessionChannel(self, session, widget))
+        self._tabs.currentChanged.connect(self._screens.setCurrentIndex)
+        layout = QVBoxLayout(central)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.setSpacing(0)
+        layout.addWidget(self._tabs)
+        layout.addWidget(self._screens)
+        self.setCentralWidget(central)
+        self._blink_timer = QTimer(self)
+        self._blink_timer.timeout.connect(self._on_blink_timer)
+        self._blink_timer.start(BLINK_INTERVAL)
+        if any(channel.needs_polling() for channel in self._channels):
+            self._read_timer = QTimer(self)
+            self._read_timer.timeout.connect(self._on_read_timer)
+            self._read_timer.start(POLL_INTERVAL)
 
-    def _on_read_timer(self):
-        if self._protocol is not None:
-            if self._protocol.process():
-                self._main_widget.update()
+    def closeEvent(self, e: QCloseEvent) -> None:
+        for channel in self._channels:
+            channel.close()
+        super().closeEvent(e)
 
-    def resizeEvent(self, e: QResizeEvent) -> None:
-        super().resizeEvent(e)
-        self._main_widget.set_window_size(self.size())
+    def _current_channel(self) -> Channel:
+        return self._channels[self._tabs.currentIndex()]
+
+    def _on_blink_timer(self):
+        # Only the session on screen blinks, the others catch up when they are shown
+        widget = self._current_channel().get_widget()
+        if widget.get_canvas().process_blink():
+            widget.update_damage()
+        if self._show_metrics:
+            widget.set_overlay(self._metrics_lines(self._current_channel()))
+
+    def _metrics_lines(self, channel: Channel) -> List[str]:
+        metrics = channel.get_session().get_metrics()
+        if metrics is None:
+            return ['Metrics are off, start with --metrics FILE']
+        # The worker thread may be recording, so everything is read from one snapshot
+        snapshot = metrics.snapshot()
+        counters = snapshot['counters']
+        parse = snapshot['histograms'].get('parse_ms', {})
+        paint = snapshot['histograms'].get('paint_ms', {})
+        top = list(snapshot['commands'].items())[:4]
+        lines = [
+            f"in {counters.get('bytes_received', 0)} B  glyphs {counters.get('glyphs', 0)}"
+            f"  cmds {sum(snapshot['commands'].values())}",
+            f"parse ms p50 {parse.get('p50', 0):.2f} p95 {parse.get('p95', 0):.2f} max {parse.get('max', 0):.2f}",
+            f"paint ms p50 {paint.get('p50', 0):.2f} p95 {paint.get('p95', 0):.2f} max {paint.get('max', 0):.2f}",
+            'top ' + '  '.join(f'{name} {n}' for name, n in top),
+        ]
+        display = channel.get_session().get_protocol().get_display_list().stats()
+        lines.append(f"display ops {display['recorded']}  dropped {display['dropped']}  folded {display['folded']}")
+        io = channel.get_session().get_io()
+        if hasattr(io, 'output_queue_depth'):
+            lines.append(f'out queue {io.output_queue_depth()} B  peak {io.output_queue_peak()} B')
+        if isinstance(channel, ThreadedSessionChannel):
+            stats = channel.get_worker().stats()
+            lines.append(f"batches {stats['batches']}  peak {stats['queue_peak']}  full {stats['queue_full']}"
+                         f"  latency {stats['latency_mean_ms']:.1f} ms")
+        return lines
+
+    def metrics_report(self) -> List[Dict]:
+        """ Metrics of every session that collects them, ready for json.dumps """
+        report = []
+        for channel in self._channels:
+            session = channel.get_session()
+            if session.get_metrics() is None:
+                continue
+            entry = {'name': session.get_name(), **session.get_metrics().snapshot()}
+            entry['display_list'] = session.get_protocol().get_display_list().stats()
+            io = session.get_io()
+            if hasattr(io, 'output_queue_depth'):
+                entry['output_queue'] = {'depth': io.output_queue_depth(), 'peak': io.output_queue_peak()}
+            if isinstance(channel, ThreadedSessionChannel):
+                entry['worker'] = channel.get_worker().stats()
+            report.append(entry)
+        return report
+
+    def _on_read_timer(self):
+        for channel in self._channels:
+            if channel.needs_polling():
+                channel.poll()
 
     def keyPressEvent(self, e: QKeyEvent) -> None:
         super().keyPressEvent(e)
         text = e.text()
         key = e.key()
+        modifiers = e.modifiers()
+        if modifiers & Qt.ControlModifier and key in (Qt.Key_PageUp, Qt.Key_PageDown):
+            # Ctrl+PageUp/PageDown switch between sessions
+            step = -1 if key == Qt.Key_PageUp else 1
+            self._tabs.setCurrentIndex((self._tabs.currentIndex() + step) % self._tabs.count())
+            return
+        channel = self._current_channel()
+        widget = channel.get_widget()
+        if key == Qt.Key_F12:
+            # F12 shows and hides the metrics overlay
+            self._show_metrics = not self._show_metrics
+            for other in self._channels:
+                other.get_widget().set_overlay([])
+            if self._show_metrics:
+                widget.set_overlay(self._metrics_lines(channel))
+            return
+        if modifiers & Qt.ShiftModifier and key in (Qt.Key_PageUp, Qt.Key_PageDown):
+            # Shift+PageUp/PageDown browse the scrollback, plain PageUp/PageDown go to the server
+            page = widget.page_lines()
+            widget.scroll_history(page if key == Qt.Key_PageUp else -page)
+            return
         if not text and key in key_map:
             text = key_map[key]
         if text:
@@ -98,21 +527,59 @@ class MainWindow(QMainWindow):
                     text = b'\r\x00'
                 else:
                     text = bytes(text, 'ascii')
-            self._io.write(text)
+            widget.scroll_history(-len(widget.get_canvas().get_scrollback()))
+            channel.write(text)
 
 
-def run_terminal(host: str, port: int):
-    try:
-        client = TelnetClient(host, int(port))
-        if client.connect():
-            app = QApplication(sys.argv)
-            window = MainWindow(client)
-            window.show()
-            app.exec_()
+def _parse_servers(servers: Tuple[Union[str, int], ...]) -> List[Tuple[str, int]]:
+    # Servers are given as host:port, or as a host followed by its port. The port defaults to 23.
+    # Callers like run.py may pass the port as an int
+    result = []
+    args = [str(arg) for arg in servers]
+    while args:
+        host = args.pop(0)
+        if ':' in host:
+            host, port = host.rsplit(':', 1)
+        elif args and args[0].isdigit():
+            port = args.pop(0)
         else:
-            print("Failed to connect")
+            port = '23'
+        result.append((host, int(port)))
+    return result
+
+
+def run_terminal(*servers, scrollback: int = DEFAULT_SCROLLBACK_LINES, integer_scale: bool = False,
+                 threaded: bool = False, metrics: str = None):
+    """
+    Connect to one or more BBSes, each in its own tab (Ctrl+PageUp/PageDown to switch).
+    Servers are host:port or host port. --scrollback sets how many lines of history are kept,
+    --integer-scale scales the screen by whole multiples only, for sharp pixels,
+    --threaded reads and parses each session on a thread of its own,
+    --metrics collects performance metrics (F12 shows them) and writes them to the given JSON file on exit
+    """
+    try:
+        addresses = _parse_servers(servers)
     except ValueError:
         print("Invalid port number")
+        return
+    if not addresses:
+        print("No server given")
+        return
+    sessions = []
+    for host, port in addresses:
+        client = TelnetClient(host, port)
+        if client.connect():
+            sessions.append(Session(client, f'{host}:{port}', scrollback, Metrics() if metrics else None))
+        else:
+            print(f"Failed to connect to {host}:{port}")
+    if sessions:
+        app = QApplication(sys.argv)
+        window = MainWindow(sessions, integer_scale, threaded)
+        window.show()
+        app.exec_()
+        if metrics:
+            with open(metrics, 'w') as f:
+                json.dump(window.metrics_report(), f, indent=2)
 
 
 def main():
@@ -0,0 +1,79 @@
+import threading
+import time
+from typing import Dict
+import numpy as np
+
+# Samples kept per histogram, older ones are overwritten
+HISTOGRAM_SAMPLES = 1024
+
+
+class Histogram:
+    """ The most recent samples of a measurement, in a ring that is allocated up front """
+
+    def __init__(self, size: int = HISTOGRAM_SAMPLES):
+        self._samples = np.zeros(size)
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, value: float):
+        self._samples[self._count % len(self._samples)] = value
+        self._count += 1
+
+    def summary(self) -> Dict[str, float]:
+        """ Count of all samples, and the distribution of the ones still in the ring """
+        samples = self._samples[:min(self._count, len(self._samples))]
+        if len(samples) == 0:
+            return {'count': 0}
+        p50, p95, p99 = np.percentile(samples, (50, 95, 99)).tolist()
+        return {'count': self._count, 'mean': round(float(samples.mean()), 3), 'p50': round(p50, 3),
+                'p95': round(p95, 3), 'p99': round(p99, 3), 'max': round(float(samples.max()), 3)}
+
+
+class Metrics:
+    """
+    Counters and timing histograms of one session.
+    Collecting is opt-in: code that measures takes an optional Metrics and does nothing when it is None.
+    With a parse worker, the worker and the GUI thread both record while the GUI reads, so every access is locked.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._counters: Dict[str, int] = {}
+        # Commands by escape character and command, e.g. '[m' for SGR or '/D' for draw sprite
+        self._commands: Dict[str, int] = {}
+        self._histograms: Dict[str, Histogram] = {}
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def command(self, name: str):
+        with self._lock:
+            self._commands[name] = self._commands.get(name, 0) + 1
+
+    def sample(self, name: str, value: float):
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+
+    def snapshot(self) -> Dict:
+        """ Everything collected so far, ready for json.dumps """
+        with self._lock:
+            counters = dict(self._counters)
+            commands = dict(self._commands)
+            histograms = {name: h.summary() for name, h in self._histograms.items()}
+        escapes: Dict[str, int] = {}
+        for name, n in commands.items():
+            escapes[name[0]] = escapes.get(name[0], 0) + n
+        return {
+            'seconds': round(time.monotonic() - self._start, 3),
+            'counters': counters,
+            'escapes': escapes,
+            'commands': dict(sorted(commands.items(), key=lambda item: -item[1])),
+            'histograms': histograms,
+        }
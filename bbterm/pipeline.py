@@ -0,0 +1,209 @@
+import queue
+import select
+import socket
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+import numpy as np
+from .canvas import Canvas
+from .scrollback import CELL_DTYPE
+from .session import Session
+
+# Render batches waiting for the GUI thread. While they are all waiting, the worker keeps parsing and merges its damage
+MAX_BATCHES = 4
+POLL_INTERVAL = 0.01  # seconds, for streams that can't be waited on
+# Hand-off latencies kept for stats()
+LATENCY_SAMPLES = 256
+
+
+class RenderBatch:
+    """
+    What changed on the parsing canvas since the previous batch: pixels of the damaged areas,
+    the lines that scrolled into the history, and the cursor state.
+    """
+
+    def __init__(self, patches: List[Tuple[int, int, np.ndarray]], history: np.ndarray,
+                 cursor: Tuple[int, int], blink: bool):
+        self.patches = patches
+        self.history = history
+        self.cursor = cursor
+        self.blink = blink
+        self.created = time.monotonic()
+
+    def size(self) -> int:
+        """ Bytes of pixels and cells in the batch """
+        return sum(pixels.nbytes for _, _, pixels in self.patches) + self.history.nbytes
+
+    def apply(self, canvas: Canvas):
+        for x, y, pixels in self.patches:
+            canvas.draw_sub_image(x, y, pixels)
+        if len(self.history) > 0:
+            canvas.get_scrollback().push(self.history)
+        canvas.set_cursor(self.cursor)
+        if canvas.get_blink() != self.blink:
+            canvas.set_blink(self.blink)
+
+
+class ParseWorker:
+    """
+    Reads and parses a session on a thread of its own, so a burst of input can't hold up the GUI.
+
+    Once started, the worker owns the session's stream, protocol and canvas. The GUI thread shows a
+    display canvas (see create_display), applies the batches it takes with take_batch(), and hands
+    keystrokes over with send(). At most max_batches are waiting at any time.
+    """
+
+    def __init__(self, session: Session, max_batches: int = MAX_BATCHES):
+        self._session = session
+        self._io = session.get_io()
+        self._canvas = session.get_canvas()
+        self._protocol = session.get_protocol()
+        self._notify: Callable[[], None] = lambda: None
+        self._batches: queue.Queue = queue.Queue(max_batches)
+        self._outgoing: queue.SimpleQueue = queue.SimpleQueue()
+        # Wakes the worker up from select() when there is something to send, a free slot, or it should stop
+        self._wake_reader, self._wake_writer = socket.socketpair()
+        self._wake_reader.setblocking(False)
+        self._wake_writer.setblocking(False)
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name=f'parse {session.get_name()}', daemon=True)
+        self._history_total = self._canvas.get_scrollback().total()
+        self._published = 0
+        self._published_bytes = 0
+        self._queue_full = 0
+        self._queue_peak = 0
+        self._latencies = np.zeros(LATENCY_SAMPLES)
+        self._latency_count = 0
+
+    def create_display(self) -> Canvas:
+        """ A canvas for the GUI thread to apply batches to, shaped like the session's """
+        return Canvas(self._canvas.width(), self._canvas.height(), self._canvas.get_scrollback().capacity())
+
+    def start(self, notify: Callable[[], None]):
+        """ Start the thread. notify is called on the worker thread whenever a batch is queued """
+        self._notify = notify
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        if self._running:
+            self._running = False
+            self._wake()
+            self._thread.join()
+            self._wake_reader.close()
+            self._wake_writer.close()
+
+    def send(self, data: bytes):
+        """ Queue data for the server, called from the GUI thread """
+        self._outgoing.put(data)
+        self._wake()
+
+    def take_batch(self) -> Optional[RenderBatch]:
+        """ The oldest waiting batch, or None """
+        was_full = self._batches.full()
+        try:
+            batch = self._batches.get_nowait()
+        except queue.Empty:
+            return None
+        if was_full:
+            # The worker held its changes back for lack of room
+            self._wake()
+        self._latencies[self._latency_count % LATENCY_SAMPLES] = time.monotonic() - batch.created
+        self._latency_count += 1
+        return batch
+
+    def pending(self) -> int:
+        return self._batches.qsize()
+
+    def stats(self) -> dict:
+        latencies = self._latencies[:min(self._latency_count, LATENCY_SAMPLES)]
+        return {
+            'batches': self._published,
+            'batch_bytes': self._published_bytes,
+            'queue_depth': self._batches.qsize(),
+            'queue_peak': self._queue_peak,
+            'queue_full': self._queue_full,
+            'latency_mean_ms': round(float(latencies.mean()) * 1000, 3) if len(latencies) else 0.0,
+            'latency_max_ms': round(float(latencies.max()) * 1000, 3) if len(latencies) else 0.0,
+        }
+
+    def _wake(self):
+        try:
+            self._wake_writer.send(b'\x00')
+        except (BlockingIOError, OSError):
+            # A full buffer already has a wake up pending
+            pass
+
+    def _run(self):
+        try:
+            fd = self._io.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        dirty = True
+        while self._running:
+            connected = self._session.is_connected()
+            readers = [self._wake_reader]
+            writers = []
+            timeout = None if fd is not None else POLL_INTERVAL
+            if fd is not None and connected:
+                if self._protocol.wants_input():
+                    readers.append(fd)
+                if getattr(self._io, 'output_queue_depth', lambda: 0)() > 0:
+                    writers.append(fd)
+            if self._protocol.has_backlog():
+                timeout = 0
+            elif dirty and self._canvas.frame_remaining() > 0:
+                # Publish what the frame drew by its deadline, even if the end of frame never arrives
+                remaining = self._canvas.frame_remaining()
+                timeout = remaining if timeout is None else min(timeout, remaining)
+            readable, _, _ = select.select(readers, writers, [], timeout)
+            if self._wake_reader in readable:
+                try:
+                    while self._wake_reader.recv(4096):
+                        pass
+                except BlockingIOError:
+                    pass
+            self._send_outgoing()
+            if fd is None or fd in readable or self._protocol.has_backlog():
+                if self._protocol.process():
+                    dirty = True
+                    # The server may have asked for a reply
+                    self._io.flush()
+            if dirty:
+                dirty = not self._publish()
+
+    def _send_outgoing(self):
+        written = False
+        while True:
+            try:
+                data = self._outgoing.get_nowait()
+            except queue.Empty:
+                break
+            self._io.write(data)
+            written = True
+        if written or getattr(self._io, 'output_queue_depth', lambda: 0)() > 0:
+            self._io.flush()
+
+    def _publish(self) -> bool:
+        """ Queue the changes made so far. False while a frame is open or no slot is free """
+        if self._canvas.frame_remaining() > 0:
+            return False
+        if self._batches.full():
+            # Keep parsing, the damage merges until the GUI catches up
+            self._queue_full += 1
+            return False
+        pixels = self._canvas.get_pixels()
+        patches = [(x, y, pixels[y:y + h, x:x + w].copy()) for x, y, w, h in self._canvas.take_damage()]
+        scrollback = self._canvas.get_scrollback()
+        count = min(scrollback.total() - self._history_total, len(scrollback))
+        history = np.empty((count, self._canvas.get_cells().shape[1]), dtype=CELL_DTYPE)
+        for k in range(count):
+            history[k] = scrollback.line(count - k)
+        self._history_total = scrollback.total()
+        batch = RenderBatch(patches, history, self._canvas.get_cursor(), self._canvas.get_blink())
+        self._batches.put_nowait(batch)
+        self._published += 1
+        self._published_bytes += batch.size()
+        self._queue_peak = max(self._queue_peak, self._batches.qsize())
+        self._notify()
+        return True
@@ -1,70 +1,143 @@
+import re
+import time
 from io import IOBase
-from typing import List, Callable, Tuple, Optional
-from PyQt5.QtGui import QPixmap
+from typing import Callable, Optional
 from .canvas import Canvas
+from .display_list import DisplayList, RecordingCanvas
 from .errors import ProtocolError
 from .font import SIZE
 from .debug_utils import diag
+from .metrics import Metrics
 from bbterm.extensions import extensions
 
+_printable_run = re.compile(rb'[\x20-\xff]+')
+
+READ_SIZE = 65536
+# Stop reading once this much input is waiting to be parsed. Must exceed the largest command (64KB + header)
+HIGH_WATER_MARK = 1024 * 1024
+# Bytes parsed per process() call, so a flood can't hold up the event loop
+PARSE_BUDGET = 256 * 1024
+COMPACT_THRESHOLD = 64 * 1024
+
+
 class ClientProtocol:
-	def __init__(self, io: IOBase, canvas: Canvas):
+	def __init__(self, io: IOBase, canvas: Canvas,
+				 high_water_mark: int = HIGH_WATER_MARK, parse_budget: int = PARSE_BUDGET,
+				 metrics: Optional[Metrics] = None):
 		self._data = bytearray()
+		self._offset = 0
+		self._stalled = False
+		self._high_water_mark = max(high_water_mark, 2 * READ_SIZE)
+		self._parse_budget = parse_budget
 		self._io = io
 		self._cur_font = 0
 		self._canvas = canvas
-		self._cursor_stack: List[Tuple[int, int]] = []
+		# Handlers draw into a display list, which is optimized and executed once per processing step
+		self._recorder = RecordingCanvas(canvas, DisplayList())
 		self._csi_terminators = ''
-		self._saved_background: Optional[QPixmap] = None
 		self._extensions = [Class() for Class in extensions]
 		self._processors = {ord(e.get_escape_pattern()): e.process for e in self._extensions}
+		# Names the command an extension just processed for the metrics, None if it was dropped
+		self._commands = {ord(e.get_escape_pattern()): e.get_command for e in self._extensions}
+		self._metrics = metrics
 
 	def process(self):
 		res = False
-		if self._canvas.process_blink_counter():
-			res = True
-		data = self._io.read(65536)
-		if data is not None and len(data) > 0:
-			self._data.extend(data)
-			res |= self._parse()
+		pending = len(self._data) - self._offset
+		if pending < self._high_water_mark:
+			data = self._io.read(min(READ_SIZE, self._high_water_mark - pending))
+			if data is not None and len(data) > 0:
+				self._data.extend(data)
+				self._stalled = False
+				if self._metrics is not None:
+					self._metrics.count('bytes_received', len(data))
+		if not self._stalled and self._offset < len(self._data):
+			start = time.perf_counter()
+			try:
+				res = self._parse()
+			finally:
+				self._recorder.execute()
+			if self._metrics is not None:
+				self._metrics.sample('parse_ms', (time.perf_counter() - start) * 1000)
+		if self._stalled and not self.wants_input():
+			# No command is this long, so the stalled one is malformed. Reading must not stop for good
+			self._drop_backlog()
 		return res
 
+	def wants_input(self) -> bool:
+		""" False while the unparsed backlog is at or above the high-water mark """
+		return len(self._data) - self._offset < self._high_water_mark
+
+	def get_display_list(self) -> DisplayList:
+		return self._recorder.get_display_list()
+
+	def has_backlog(self) -> bool:
+		""" True if buffered input can be parsed without waiting for more data """
+		return not self._stalled and self._offset < len(self._data)
+
 	def _parse(self):
 		n = len(self._data)
-		i = 0
+		i = self._offset
+		limit = min(n, i + self._parse_budget)
 		res = False
-		while i < n:
+		while i < limit:
 			try:
 				c = self._data[i]
 				if c == 27:
 					escape_character = self._data[i + 1]
-					diag(f'Processing escape character: {chr(escape_character)}')
+					diag('Processing escape character: %c', escape_character)
 					if escape_character in self._processors:
 						processor: Callable[[Canvas, bytearray, int], int] = self._processors[escape_character]
-						j = processor(self._canvas, self._data, i, self._io)
+						j = processor(self._recorder, self._data, i, self._io)
 						if j > i:
+							if self._metrics is not None:
+								command = self._commands[escape_character](self._data, i, j)
+								if command is not None:
+									self._metrics.command(chr(escape_character) + command)
 							i = j
 							res = True
 						else:
+							self._stalled = True
 							break
 					else:
 						raise RuntimeError("Unsupported code")
+				elif c >= 32:
+					j = _printable_run.match(self._data, i, limit).end()
+					self._draw_run(i, j)
+					if self._metrics is not None:
+						self._metrics.count('glyphs', j - i)
+					res = True
+					i = j
 				else:
 					self._handle_char(c)
 					res = True
 					i += 1
-			except IndexError:
-				self._data = self._data[i:]
-				return res
-			except ProtocolError:
-				self._data = self._data[i:]
-				return res
-		if i<n:
-			self._data = self._data[i:]
-		else:
-			self._data.clear()
+			except (IndexError, ProtocolError):
+				self._stalled = True
+				break
+		self._consume(i)
 		return res
 
+	def _drop_backlog(self):
+		# Discard the stalled command and the rest of the buffered input, which it would have spanned
+		diag('Dropping %d bytes of input after an unterminated command', len(self._data) - self._offset)
+		for extension in self._extensions:
+			extension.reset()
+		self._data.clear()
+		self._offset = 0
+		self._stalled = False
+
+	def _consume(self, i: int):
+		# Advance the read offset, compacting the buffer only once the consumed prefix is large
+		if i >= len(self._data):
+			self._data.clear()
+			self._offset = 0
+		elif i >= COMPACT_THRESHOLD and i * 2 >= len(self._data):
+			del self._data[:i]
+			self._offset = 0
+		else:
+			self._offset = i
+
 	def _handle_char(self, ch: int):
 		if ch == 8:
 			cursor = self._canvas.get_cursor()
@@ -78,21 +151,26 @@ class ClientProtocol:
 					x = 0
 			self._canvas.set_cursor((x, y))
 		elif ch == 13:
-			self._canvas.set_cursor((0, self._canvas.get_cursor()[1] + SIZE))
-		elif ch >= 32:
-			self._draw_char(ch)
+			self._canvas.set_cursor((0, self._line_feed(self._canvas.get_cursor()[1])))
 
-	def _draw_char(self, ch: int):
-		if ch > 0:
-			font = self._canvas.get_font()
-			cursor = self._canvas.get_cursor()
-			font.draw_char(cursor[0], cursor[1], ch)
-			x = cursor[0] + SIZE
-			y = cursor[1]
+	def _draw_run(self, start: int, end: int):
+		# Draw a run of printable characters, split at line wraps
+		font = self._canvas.get_font()
+		x, y = self._canvas.get_cursor()
+		while start < end:
+			count = min(end - start, (font.right_most() - x) // SIZE + 1)
+			self._recorder.draw_glyphs(x, y, self._data[start:start + count])
+			start += count
+			x += count * SIZE
 			if x > font.right_most():
 				x = 0
-				y += SIZE
-				if y > font.bottom_most():
-					font.scroll()
-					y -= SIZE
-			self._canvas.set_cursor((x, y))
+				y = self._line_feed(y)
+		self._canvas.set_cursor((x, y))
+
+	def _line_feed(self, y: int) -> int:
+		# The row below y, scrolling when y is the last row of the scroll region
+		bottom = self._canvas.get_scroll_region()[1]
+		if (bottom - 1) * SIZE <= y < bottom * SIZE:
+			self._recorder.scroll_lines(1, *self._canvas.get_font().get_colors(), history=True)
+			return y
+		return min(y + SIZE, self._canvas.get_font().bottom_most())
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import numpy as np
+from .inline_font import SIZE
+
+# A text cell: glyph index, foreground and background colors as 0xRRGGBB, and CELL_* flags
+CELL_DTYPE = np.dtype([('ch', 'u1'), ('fg', '<u4'), ('bg', '<u4'), ('flags', 'u1')])
+BLANK = 32
+# The cell's pixels are exactly its glyph in its colors, nothing was drawn over it since
+CELL_DRAWN = 0x01
+DEFAULT_SCROLLBACK_LINES = 2000
+
+# Rendered history lines kept around for scrolling back and forth
+RENDERED_LINES = 128
+
+
+class Scrollback:
+    """
+    Lines that scrolled off the top of the screen.
+
+    Lines are stored as cells (10 bytes per character) in a ring that is allocated up front,
+    and turned into pixels only when they are scrolled back into view.
+    """
+
+    def __init__(self, columns: int, max_lines: int = DEFAULT_SCROLLBACK_LINES):
+        self._lines = np.zeros((max(max_lines, 0), columns), dtype=CELL_DTYPE)
+        self._next = 0
+        self._count = 0
+        self._total = 0
+        self._rendered: OrderedDict = OrderedDict()
+
+    def __len__(self):
+        return self._count
+
+    def capacity(self) -> int:
+        return len(self._lines)
+
+    def total(self) -> int:
+        """ Number of lines pushed so far, including the ones that dropped out of the ring """
+        return self._total
+
+    def push(self, rows: np.ndarray):
+        """ Append rows of cells, oldest first """
+        capacity = len(self._lines)
+        if capacity == 0:
+            return
+        for row in rows[-capacity:]:
+            self._lines[self._next] = row
+            self._next = (self._next + 1) % capacity
+        self._count = min(self._count + len(rows), capacity)
+        self._total += len(rows)
+
+    def line(self, age: int) -> np.ndarray:
+        """ The cells of a stored line, age 1 is the line that scrolled off last """
+        if not 1 <= age <= self._count:
+            raise IndexError(age)
+        return self._lines[(self._next - age) % len(self._lines)]
+
+    def render(self, font, offset: int, screen: np.ndarray) -> np.ndarray:
+        """
+        Compose the screen as seen <offset> lines back in the history:
+        history lines on top, followed by the top of the live screen pixels.
+        """
+        offset = min(offset, self._count)
+        rows = screen.shape[0] // SIZE
+        view = np.empty_like(screen)
+        history = min(offset, rows)
+        for k in range(history):
+            age = offset - k
+            view[k * SIZE:(k + 1) * SIZE] = self._render_line(font, age)
+        view[history * SIZE:] = screen[:screen.shape[0] - history * SIZE]
+        return view
+
+    def _render_line(self, font, age: int) -> np.ndarray:
+        # Lines never change once stored, so their serial number is a stable cache key
+        serial = self._total - age
+        pixels = self._rendered.get(serial)
+        if pixels is None:
+            pixels = font.render_cells(self.line(age))
+            self._rendered[serial] = pixels
+            if len(self._rendered) > RENDERED_LINES:
+                self._rendered.popitem(last=False)
+        else:
+            self._rendered.move_to_end(serial)
+        return pixels
@@ -0,0 +1,46 @@
+from io import IOBase
+from typing import Optional
+from .canvas import Canvas
+from .font import SIZE
+from .metrics import Metrics
+from .protocol import ClientProtocol
+from .scrollback import DEFAULT_SCROLLBACK_LINES
+
+COLUMNS = 40
+ROWS = 25
+
+
+class Session:
+    """
+    One BBS connection: its stream, and the canvas and protocol state it drives.
+    Everything a connection changes lives here, so any number of sessions can share a process.
+    """
+
+    def __init__(self, io: IOBase, name: str = '', scrollback_lines: int = DEFAULT_SCROLLBACK_LINES,
+                 metrics: Optional[Metrics] = None):
+        self._io = io
+        self._name = name
+        self._metrics = metrics
+        self._canvas = Canvas(SIZE * COLUMNS, SIZE * ROWS, scrollback_lines)
+        self._protocol = ClientProtocol(io, self._canvas, metrics=metrics)
+
+    def get_io(self) -> IOBase:
+        return self._io
+
+    def get_name(self) -> str:
+        return self._name
+
+    def get_canvas(self) -> Canvas:
+        return self._canvas
+
+    def get_protocol(self) -> ClientProtocol:
+        return self._protocol
+
+    def get_metrics(self) -> Optional[Metrics]:
+        """ The session's metrics, or None if they aren't collected """
+        return self._metrics
+
+    def is_connected(self) -> bool:
+        # Streams that aren't sockets stay open for the life of the session
+        is_connected = getattr(self._io, 'is_connected', None)
+        return is_connected() if is_connected is not None else True
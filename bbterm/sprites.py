@@ -1,47 +1,44 @@
-from typing import Dict
-from PyQt5.QtGui import QImage
+import numpy as np
 from .errors import ProtocolError
 from .font import SIZE
 
 
-def rgb_to_rgba(data: bytes) -> bytes:
-    rgba_data = bytearray(SIZE * SIZE * 4)
-    source = 0
-    destination = 0
-    for i in range(SIZE * SIZE):
-        rgba_data[destination + 0] = data[source]
-        rgba_data[destination + 1] = data[source + 1]
-        rgba_data[destination + 2] = data[source + 2]
-        rgba_data[destination + 3] = 255
-        if data[source] == 0 and data[source + 1] == 0 and data[source + 2] == 0:
-            rgba_data[destination + 3] = 0
-        destination += 4
-        source += 3
-    return bytes(rgba_data)
+def rgb_to_rgba(data) -> np.ndarray:
+    rgb = np.frombuffer(data, dtype=np.uint8).reshape(SIZE, SIZE, 3)
+    rgba = np.zeros((SIZE, SIZE, 4), dtype=np.uint8)
+    rgba[:, :, :3] = rgb
+    # Black is the transparent color key. With alpha still zero, a pixel is black iff its 32 bits are zero
+    rgba[:, :, 3] = (rgba.view(np.uint32)[:, :, 0] != 0) * np.uint8(255)
+    return rgba
 
 
 class Sprite:
-    def __init__(self, data: bytes):
+    def __init__(self, data):
+        """
+        data is a bytes-like object (possibly a memoryview into the protocol buffer) with either
+        an RGB image, black being transparent, or an RGBA image. Both are a 32x32 row scan.
+        The pixels are copied, so the sprite owns its image and the caller's buffer can be reused.
+        """
         if len(data) == (SIZE * SIZE * 3):
-            data = rgb_to_rgba(data)
-        if len(data) != (SIZE * SIZE * 4):
+            image = rgb_to_rgba(data)
+        elif len(data) == (SIZE * SIZE * 4):
+            image = np.frombuffer(data, dtype=np.uint8).reshape(SIZE, SIZE, 4).copy()
+        else:
             raise ProtocolError("Invalid sprite data")
-        # Data should be RGBA 32bpp row scan of 32x32 image, 4096 bytes total
-        image = QImage(data, SIZE, SIZE, 4 * SIZE, QImage.Format_RGBA8888)
+        image.flags.writeable = False
         self._image = image
-
-    def get_image(self):
-        return self._image
-
-
-_sprites: Dict[int, Sprite] = {}
-
-
-def set_sprite(index: int, data: bytes):
-    _sprites[index] = Sprite(data)
-
-
-def get_sprite(index: int):
-    if index in _sprites:
-        return _sprites[index]
-    return None
+        alpha = image[:, :, 3]
+        counts = np.bincount(alpha.ravel(), minlength=256)
+        self._opaque = bool(counts[255] == SIZE * SIZE)
+        # Sprites with only fully transparent or opaque pixels are drawn with a mask instead of blending
+        self._mask = None
+        if not self._opaque and counts[0] + counts[255] == SIZE * SIZE:
+            self._mask = alpha[:, :, None] != 0
+
+    def draw(self, canvas, x: int, y: int):
+        if self._opaque:
+            canvas.draw_sub_image(x, y, self._image)
+        elif self._mask is not None:
+            canvas.draw_masked(x, y, self._image, self._mask)
+        else:
+            canvas.draw_image(x, y, self._image)
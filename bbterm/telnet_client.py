@@ -1,13 +1,186 @@
 import socket
-import time
+import zlib
+from typing import Optional
+from .compression import MAX_DECOMPRESSED
 from .debug_utils import diagnostic_dump, diag
+from .errors import ProtocolError
+
+IAC = 255
+DONT = 254
+DO = 253
+WONT = 252
+WILL = 251
+SB = 250
+SE = 240
+
+OPT_BINARY = 0
+OPT_ECHO = 1
+OPT_SGA = 3
+OPT_NAWS = 31
+OPT_COMPRESS2 = 86  # MCCP2
+
+# Options we let the server enable, and options we offer to enable ourselves
+_accepted_remote = {OPT_BINARY, OPT_ECHO, OPT_SGA, OPT_COMPRESS2}
+_accepted_local = {OPT_BINARY, OPT_SGA, OPT_NAWS}
+
+# Longest subnegotiation we wait for, longer ones are dropped
+MAX_SUBNEGOTIATION = 4096
+
+
+class TelnetFilter:
+	"""
+	Streaming Telnet layer between the socket and the protocol.
+
+	Strips IAC sequences from the server data, answers option negotiation, and inflates
+	the server output once MCCP2 compression starts. Data between IAC bytes is copied in
+	slices, so plain text never goes through a per byte loop.
+	The filter is enabled when the server opens with an IAC sequence, otherwise it passes
+	everything through, for servers that send raw binary payloads without Telnet escaping.
+	"""
+
+	def __init__(self, columns: int = 40, rows: int = 25, enabled: Optional[bool] = None):
+		self._enabled = enabled
+		self._size = (columns, rows)
+		self._pending = b''
+		self._inflater = None
+		self._local = set()
+		self._remote = set()
+		self._replies = bytearray()
+
+	def enabled(self) -> bool:
+		return bool(self._enabled)
+
+	def compressed(self) -> bool:
+		return self._inflater is not None
+
+	def take_replies(self) -> bytes:
+		""" Negotiation responses to send to the server, in order """
+		replies = bytes(self._replies)
+		self._replies.clear()
+		return replies
+
+	def feed(self, data: bytes) -> bytes:
+		""" Returns the data bytes, with Telnet commands removed and compression undone """
+		if self._enabled is None and data:
+			self._enabled = data[0] == IAC
+		if not self._enabled:
+			return data
+		out = bytearray()
+		while data:
+			if self._inflater is not None:
+				try:
+					plain = self._inflater.decompress(data, MAX_DECOMPRESSED)
+				except zlib.error as e:
+					raise ProtocolError(f"Invalid MCCP stream: {e}")
+				if self._inflater.unconsumed_tail:
+					raise ProtocolError("MCCP output too large")
+				data = b''
+				if self._inflater.eof:
+					# The server ended compression, the rest of the data is plain again
+					data = self._inflater.unused_data
+					self._inflater = None
+				self._parse(plain, out)
+			else:
+				data = self._parse(data, out)
+		return bytes(out)
+
+	@staticmethod
+	def escape(data: bytes) -> bytes:
+		return data.replace(b'\xff', b'\xff\xff')
+
+	def _parse(self, data: bytes, out: bytearray) -> bytes:
+		# Copy data to out and handle commands. Returns the data that follows the start of compression
+		if self._pending:
+			data = self._pending + data
+			self._pending = b''
+		n = len(data)
+		i = 0
+		while i < n:
+			j = data.find(IAC, i)
+			if j < 0:
+				out += data[i:] if i else data
+				break
+			out += data[i:j]
+			if j + 1 >= n:
+				self._pending = data[j:]
+				break
+			command = data[j + 1]
+			if command == IAC:
+				out.append(IAC)
+				i = j + 2
+			elif WILL <= command <= DONT:
+				if j + 2 >= n:
+					self._pending = data[j:]
+					break
+				self._negotiate(command, data[j + 2])
+				i = j + 3
+			elif command == SB:
+				end = data.find(b'\xff\xf0', j + 2)
+				if end < 0:
+					if n - j <= MAX_SUBNEGOTIATION:
+						self._pending = data[j:]
+					break
+				i = end + 2
+				if self._subnegotiation(data[j + 2:end]):
+					return data[i:]
+			else:
+				# NOP, GA and the other two byte commands carry nothing for us
+				i = j + 2
+		return b''
+
+	def _negotiate(self, command: int, option: int):
+		if command == WILL:
+			if option in _accepted_remote:
+				if option not in self._remote:
+					self._remote.add(option)
+					self._reply(DO, option)
+			else:
+				self._reply(DONT, option)
+		elif command == WONT:
+			if option in self._remote:
+				self._remote.discard(option)
+				self._reply(DONT, option)
+		elif command == DO:
+			if option in _accepted_local:
+				if option not in self._local:
+					self._local.add(option)
+					self._reply(WILL, option)
+				if option == OPT_NAWS:
+					self._send_window_size()
+			else:
+				self._reply(WONT, option)
+		elif command == DONT:
+			if option in self._local:
+				self._local.discard(option)
+				self._reply(WONT, option)
+
+	def _subnegotiation(self, data: bytes) -> bool:
+		# Returns True if server output is compressed from here on
+		if data[:1] == bytes((OPT_COMPRESS2,)) and OPT_COMPRESS2 in self._remote:
+			diag("MCCP2 compression started")
+			self._inflater = zlib.decompressobj()
+			return True
+		return False
+
+	def _send_window_size(self):
+		columns, rows = self._size
+		size = self.escape(bytes((columns >> 8, columns & 255, rows >> 8, rows & 255)))
+		self._replies += bytes((IAC, SB, OPT_NAWS)) + size + bytes((IAC, SE))
+
+	def _reply(self, command: int, option: int):
+		self._replies += bytes((IAC, command, option))
+
 
 class TelnetClient:
-	def __init__(self, host: str, port: int):
+	def __init__(self, host: str, port: int, telnet: Optional[bool] = None):
 		self._address = host, port
+		self._telnet = TelnetFilter(enabled=telnet)
 		self._terminating = False
 		self._connected = False
 		self._buffer = bytearray()
+		# Bytes written but not sent yet, and the most that was ever waiting
+		self._outgoing = bytearray()
+		self._outgoing_peak = 0
 		self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 		self._socket.settimeout(5.0)  # for connection
 		diagnostic_dump(None)
@@ -16,25 +189,69 @@ class TelnetClient:
 		try:
 			self._socket.connect(self._address)
 			self._socket.setblocking(False)
+			# Keystrokes are tiny packets, send them right away instead of waiting for an ACK
+			self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			self._connected = True
 			return True
 		except TimeoutError:
 			return False
 		except ConnectionRefusedError:
 			return False
 
+	def fileno(self) -> int:
+		return self._socket.fileno()
+
+	def is_connected(self) -> bool:
+		return self._connected
+
 	def write(self, data: bytes):
-		i = 0
-		n = len(data)
-		while i < n:  # socket is non-blocking. Loop until everything is sent
-			i += self._socket.send(data[i:n])
-			if i < n:
-				time.sleep(0.01)  # For low volume data, this should never happen
+		""" Queue data for sending. Writes are coalesced until flush() """
+		self._outgoing.extend(self._telnet.escape(data) if self._telnet.enabled() else data)
+		self._outgoing_peak = max(self._outgoing_peak, len(self._outgoing))
+		return len(data)
+
+	def flush(self):
+		""" Send as much of the queue as the socket takes without blocking """
+		if self._outgoing and self._connected:
+			try:
+				sent = self._socket.send(self._outgoing)
+				del self._outgoing[:sent]
+			except BlockingIOError:
+				pass
+			except ConnectionError:
+				diag("Connection lost")
+				self._connected = False
+		if not self._connected:
+			self._outgoing.clear()
+
+	def output_queue_depth(self) -> int:
+		return len(self._outgoing)
+
+	def output_queue_peak(self) -> int:
+		return self._outgoing_peak
 
 	def read(self, size: int) -> bytes:
 		# Return what's available
 		try:
 			data = self._socket.recv(size)
+			if not data:
+				diag("Connection closed")
+				self._connected = False
+			data = self._telnet.feed(data)
+			replies = self._telnet.take_replies()
+			if replies:
+				# Negotiation is answered right away, it bypasses the escaping in write()
+				self._outgoing.extend(replies)
+				self.flush()
 			diagnostic_dump(data)
 			return data
 		except BlockingIOError:
 			return bytes()
+		except ConnectionError:
+			diag("Connection lost")
+			self._connected = False
+			return bytes()
+		except ProtocolError as e:
+			diag(e.text)
+			self._connected = False
+			return bytes()
@@ -0,0 +1,132 @@
+import random
+import numpy as np
+import pytest
+from bbterm.canvas import Canvas
+from bbterm.display_list import DisplayList
+from bbterm.inline_font import SIZE
+from bbterm.protocol import ClientProtocol
+
+WIDTH, HEIGHT = SIZE * 40, SIZE * 25
+
+
+def slash(code: bytes, payload: bytes) -> bytes:
+    return b'\x1b/' + code + len(payload).to_bytes(2, 'little') + payload
+
+
+def words(*values: int) -> bytes:
+    return np.array(values, dtype='<u2').tobytes()
+
+
+def sprite(rng: random.Random, slot: int) -> bytes:
+    # Slot 0 is opaque, 1 is drawn with a mask and 2 is blended
+    if slot == 1:
+        image = np.zeros((SIZE, SIZE, 3), np.uint8)
+        image[8:24, 8:24] = rng.randrange(1, 256)
+    else:
+        image = np.full((SIZE, SIZE, 4), 255 if slot == 0 else 128, np.uint8)
+        image[..., :3] = rng.randrange(256)
+    return slash(b'S', words(slot) + image.tobytes())
+
+
+def random_stream(rng: random.Random, commands: int) -> bytes:
+    """ Text, ANSI and slash commands mixed at random, with cursors both on and off the cell grid """
+    out = bytearray(b''.join(sprite(rng, slot) for slot in range(3)))
+    for _ in range(commands):
+        r = rng.random()
+        if r < 0.3:
+            out += bytes(rng.randrange(32, 127) for _ in range(rng.randrange(1, 60)))
+        elif r < 0.4:
+            out += b'\r' * rng.randrange(1, 4)
+        elif r < 0.45:
+            out += b'\x08'
+        elif r < 0.52:
+            out += b'\x1b[%d;%dH' % (rng.randrange(0, 27), rng.randrange(0, 42))
+        elif r < 0.58:
+            out += b'\x1b[%d;%dm' % (rng.choice([0, 1, 5, 25]), rng.randrange(30, 48))
+        elif r < 0.63:
+            out += b'\x1b[%dJ' % rng.randrange(0, 3)
+        elif r < 0.68:
+            out += b'\x1b[%dK' % rng.randrange(0, 3)
+        elif r < 0.72:
+            out += b'\x1b[%d%s' % (rng.randrange(0, 5), rng.choice([b'L', b'M']))
+        elif r < 0.75:
+            out += rng.choice([b'\x1b[r', b'\x1b[%d;%dr' % (rng.randrange(1, 12), rng.randrange(12, 26))])
+        elif r < 0.80:
+            x, y = rng.randrange(0, WIDTH + 20), rng.randrange(0, HEIGHT + 20)
+            if rng.random() < 0.5:
+                x, y = x // SIZE * SIZE, y // SIZE * SIZE
+            out += slash(b'H', words(x, y))
+        elif r < 0.85:
+            out += slash(b'D', words(rng.randrange(0, 4)))
+        elif r < 0.88:
+            out += slash(b'M', b''.join(words(rng.randrange(4), rng.randrange(WIDTH + 20), rng.randrange(HEIGHT + 20))
+                                        for _ in range(rng.randrange(1, 5))))
+        elif r < 0.90:
+            out += slash(b'A', bytes([rng.randrange(3)]))
+        elif r < 0.92:
+            out += slash(b'B', bytes([rng.randrange(3)]))
+        elif r < 0.96:
+            out += slash(b'R', bytes([rng.randrange(3)]) + words(rng.randrange(WIDTH + 20), rng.randrange(HEIGHT + 20),
+                                                                  rng.randrange(1, 200), rng.randrange(1, 200)))
+        elif r < 0.98:
+            out += slash(b'F', bytes([rng.randrange(2)]))
+        else:
+            out += b'\n'
+    return bytes(out)
+
+
+class ChunkedStream:
+    """ Hands the data out in chunks of random size, so processing steps end in different places """
+
+    def __init__(self, data: bytes, seed: int):
+        self._data = data
+        self._rng = random.Random(seed)
+
+    def read(self, n: int) -> bytes:
+        k = min(n, self._rng.randrange(1, 3000))
+        chunk, self._data = self._data[:k], self._data[k:]
+        return chunk
+
+    def write(self, data: bytes):
+        return len(data)
+
+    def remaining(self) -> int:
+        return len(self._data)
+
+
+def render(data: bytes, seed: int, optimize: bool):
+    canvas = Canvas(WIDTH, HEIGHT, 100)
+    stream = ChunkedStream(data, seed)
+    protocol = ClientProtocol(stream, canvas)
+    protocol.get_display_list().set_optimize(optimize)
+    while stream.remaining() or protocol.has_backlog():
+        protocol.process()
+    scrollback = canvas.get_scrollback()
+    history = [scrollback.line(k).copy() for k in range(1, len(scrollback) + 1)]
+    return canvas, history, protocol.get_display_list().stats()
+
+
+@pytest.mark.parametrize('seed', range(60))
+def test_optimized_execution_matches_replay(seed):
+    data = random_stream(random.Random(seed), 400)
+    expected, expected_history, _ = render(data, seed, optimize=False)
+    actual, history, stats = render(data, seed, optimize=True)
+    assert np.array_equal(actual.get_pixels(), expected.get_pixels())
+    assert np.array_equal(actual.get_cells(), expected.get_cells())
+    assert actual.get_cursor() == expected.get_cursor()
+    assert len(history) == len(expected_history)
+    assert all(np.array_equal(a, b) for a, b in zip(history, expected_history))
+    assert stats['recorded'] > 0
+
+
+def test_overdrawn_text_is_dropped():
+    canvas = Canvas(WIDTH, HEIGHT)
+    display = DisplayList()
+    display.glyphs(0, 0, b'old', 0xFFFFFF, 0)
+    display.glyphs(SIZE * 5, 0, b'kept', 0xFFFFFF, 0)
+    display.glyphs(0, 0, b'new', 0xFFFFFF, 0)
+    assert [record['text'] for record in display.records()] == [b'old', b'kept', b'new']
+    display.execute(canvas)
+    assert display.stats() == {'recorded': 3, 'dropped': 1, 'folded': 0}
+    assert bytes(canvas.get_cells()[0]['ch'][:9]) == b'new  kept'
+    assert len(display) == 0
@@ -0,0 +1,32 @@
+from bbterm.canvas import Canvas
+from bbterm.inline_font import SIZE
+from bbterm.metrics import Metrics
+from bbterm.protocol import ClientProtocol
+
+
+class Stream:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self, n: int) -> bytes:
+        chunk, self._data = self._data[:n], self._data[n:]
+        return chunk
+
+    def write(self, data: bytes):
+        return len(data)
+
+
+def commands(data: bytes):
+    metrics = Metrics()
+    protocol = ClientProtocol(Stream(data), Canvas(SIZE * 40, SIZE * 25), metrics=metrics)
+    while protocol.process():
+        pass
+    return metrics.snapshot()['commands']
+
+
+def test_commands_are_counted_by_final_byte():
+    assert commands(b'\x1b[5;1H\x1b[1;31mA\x1b[m\x1b/H\x04\x00\x00\x00\x00\x00') == {'[m': 2, '[H': 1, '/H': 1}
+
+
+def test_dropped_sequences_are_not_counted():
+    assert commands(b'\x1b[1\x01\x1b[\x01\x1b[' + b'1;' * 40 + b'm') == {}
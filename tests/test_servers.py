@@ -0,0 +1,19 @@
+import pytest
+from bbterm.main import _parse_servers
+
+
+def test_host_and_int_port():
+    assert _parse_servers(('localhost', 2323)) == [('localhost', 2323)]
+
+
+def test_host_colon_port():
+    assert _parse_servers(('bbs.example.com:2323',)) == [('bbs.example.com', 2323)]
+
+
+def test_host_then_port():
+    assert _parse_servers(('alpha', '2323', 'beta:24', 'gamma')) == [('alpha', 2323), ('beta', 24), ('gamma', 23)]
+
+
+def test_invalid_port():
+    with pytest.raises(ValueError):
+        _parse_servers(('alpha:telnet',))